@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import platform
+import queue
+import random
+import subprocess
+import sys
+import time
+from array import array
+
+# Render off-screen, the benchmarks must not need a display
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+import game
+
+SEED = 48763
+MIN_CALLS = 5
+MAX_CALLS = 5000
+STROKES = 256
+
+
+def setup():
+    pygame.init()
+    game.clear_render_cache()
+    game.init_variables()
+    screen = pygame.display.set_mode((game.SCREEN_WIDTH, game.SCREEN_HEIGHT))
+    game.draw_toolbar(screen)
+    game.update_display()
+    return screen
+
+
+def stroke_inputs(count):
+    rng = random.Random(SEED)
+    grid = game.display["grid"]
+    extent = grid.cell_count * grid.cell_size
+    return [((rng.randrange(extent), rng.randrange(extent)),
+             (rng.randrange(256), rng.randrange(256), rng.randrange(256)), rng.randint(1, 5)) for _ in range(count)]
+
+
+def paint_packets(count):
+    rng = random.Random(SEED)
+    cell_count = game.display["grid"].cell_count
+    return [(rng.randrange(cell_count), rng.randrange(cell_count), rng.randrange(256), rng.randrange(256),
+             rng.randrange(256), rng.randint(1, 5)) for _ in range(count)]
+
+
+def display_grid():
+    return game.display["grid"]
+
+
+def bench_paint(screen):
+    strokes = stroke_inputs(STROKES)
+    index = 0
+
+    def run():
+        nonlocal index
+        pos, color, size = strokes[index % STROKES]
+        index += 1
+        game.paint(pos, color, size)
+    return run
+
+
+def bench_fill_blank(screen):
+    grid = display_grid()
+    colors = [(0, 0, 0), grid.color]
+    index = 0
+
+    def run():
+        # Alternate colours so every call floods the whole canvas
+        nonlocal index
+        game.fill((32, 32), colors[index % 2])
+        index += 1
+    return run
+
+
+def bench_fill_region(screen):
+    grid = display_grid()
+    grid.clean()
+    # A ring leaves a region of about a quarter of the canvas inside it
+    for i in range(16, 48):
+        for x, y in ((i, 16), (i, 47), (16, i), (47, i)):
+            game.paint_cells((x, y), (0, 0, 0), 1)
+    colors = [grid.color, (200, 30, 30)]
+    index = 0
+
+    def run():
+        nonlocal index
+        game.fill((32, 32), colors[index % 2 - 1])
+        index += 1
+    return run
+
+
+def bench_decode_paint(screen):
+    packets = paint_packets(STROKES)
+    index = 0
+
+    def run():
+        nonlocal index
+        game.decode_packet(None, screen, "PAINT", packets[index % STROKES])
+        index += 1
+    return run
+
+
+def bench_decode_line(screen):
+    packets = paint_packets(STROKES)
+    segments = [(r, g, b, size, ((x, y), ((x + 3) % 64, (y + 2) % 64), ((x + 5) % 64, (y + 5) % 64)))
+                for x, y, r, g, b, size in packets]
+    index = 0
+
+    def run():
+        # A frame's worth of mouse motion arriving as one segment
+        nonlocal index
+        game.decode_packet(None, screen, "LINE", segments[index % STROKES])
+        index += 1
+    return run
+
+
+def bench_apply_burst(screen):
+    packets = paint_packets(STROKES)
+    msg_queue = queue.Queue()
+
+    def run():
+        # A second of painting from a fast painter landing in one frame, batched like the socket thread does
+        batch = array("B")
+        for packet in packets:
+            game.add_stamps(batch, "PAINT", packet)
+        msg_queue.put(("STAMPS", batch))
+        game.apply_messages(msg_queue, None, screen)
+    return run
+
+
+def bench_load_snapshot(screen):
+    grid = display_grid()
+    for pos, color, size in stroke_inputs(STROKES):
+        game.paint(pos, color, size)
+    snapshot = grid.canvas.snapshot()
+    return lambda: grid.load_snapshot(snapshot)
+
+
+def bench_snapshot(screen):
+    grid = display_grid()
+    for pos, color, size in stroke_inputs(STROKES):
+        game.paint(pos, color, size)
+    return lambda: grid.canvas.snapshot()
+
+
+def bench_grid_draw(screen):
+    grid = display_grid()
+    return lambda: grid.draw(screen)
+
+
+def bench_draw_palette(screen):
+    return lambda: game.draw_palette(screen)
+
+
+def bench_palette_render(screen):
+    hue = 0
+
+    def run():
+        # Skip the cache, every call renders a new hue
+        nonlocal hue
+        game.palette_surface.__wrapped__(hue)
+        hue = (hue + 1) % 361
+    return run
+
+
+def bench_hue_bar_render(screen):
+    return lambda: game.hue_bar_surface(180, 10)
+
+
+def bench_hue_drag(screen):
+    slider = game.sliders["hue"]
+    game.palette_surface.cache_clear()
+    offset = 0
+
+    def run():
+        # Drag the hue slider back and forth, redrawing it and the palette like main() does
+        nonlocal offset
+        slider.pos[0] = slider.init_pos[0] - 87 + offset % 180
+        offset += 7
+        slider.draw(screen)
+        game.draw_palette(screen)
+        game.update_display()
+    return run
+
+
+def bench_color_slider_draw(screen):
+    slider = game.sliders["hue"]
+    return lambda: slider.draw(screen)
+
+
+def bench_slider_draw(screen):
+    slider = game.sliders["brush"]
+    return lambda: slider.draw(screen)
+
+
+def bench_draw_tools(screen):
+    return lambda: game.draw_tools(screen)
+
+
+def bench_draw_counter(screen):
+    game.game_variables["timer_text"] = "Turn of bench"
+    timer = 0
+
+    def run():
+        # The countdown changes the text every call, which leaves only the text cache to help
+        nonlocal timer
+        game.game_variables["timer"] = timer % 60 + 1
+        timer += 1
+        game.draw_counter(screen)
+    return run
+
+
+def bench_draw_toolbar(screen):
+    return lambda: game.draw_toolbar(screen)
+
+
+def bench_frame_locked(screen):
+    packets = paint_packets(STROKES)
+    index = 0
+    game.game_variables["locked"] = True
+
+    def run():
+        # One frame of a guesser: apply the strokes that arrived, then redraw like main() does when locked
+        nonlocal index
+        for _ in range(4):
+            game.decode_packet(None, screen, "PAINT", packets[index % STROKES])
+            index += 1
+        game.draw_locked_frame(screen)
+    return run
+
+
+def bench_frame_idle(screen):
+    game.game_variables["locked"] = True
+    # A guesser's frame while nothing arrives
+    return lambda: game.draw_locked_frame(screen)
+
+
+def bench_frame_painting(screen):
+    strokes = stroke_inputs(STROKES)
+    index = 0
+
+    def run():
+        # One frame of the painter: a local stroke, then the per-frame redraw of main()
+        nonlocal index
+        pos, color, size = strokes[index % STROKES]
+        index += 1
+        game.paint(pos, color, size)
+        game.draw_painting_frame(screen, pos)
+    return run
+
+
+BENCHMARKS = {
+    "paint": bench_paint,
+    "fill_blank": bench_fill_blank,
+    "fill_region": bench_fill_region,
+    "decode_paint": bench_decode_paint,
+    "decode_line": bench_decode_line,
+    "apply_burst": bench_apply_burst,
+    "load_snapshot": bench_load_snapshot,
+    "snapshot": bench_snapshot,
+    "grid_draw": bench_grid_draw,
+    "draw_palette": bench_draw_palette,
+    "palette_render": bench_palette_render,
+    "hue_bar_render": bench_hue_bar_render,
+    "hue_drag": bench_hue_drag,
+    "color_slider_draw": bench_color_slider_draw,
+    "slider_draw": bench_slider_draw,
+    "draw_tools": bench_draw_tools,
+    "draw_counter": bench_draw_counter,
+    "draw_toolbar": bench_draw_toolbar,
+    "frame_locked": bench_frame_locked,
+    "frame_idle": bench_frame_idle,
+    "frame_painting": bench_frame_painting,
+}
+
+
+def measure(run, budget):
+    run()
+    samples = []
+    start = time.perf_counter()
+    while len(samples) < MIN_CALLS or (time.perf_counter() - start < budget and len(samples) < MAX_CALLS):
+        t = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - t)
+    samples.sort()
+    return {
+        "calls": len(samples),
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 2),
+        "min_us": round(samples[0] * 1e6, 2),
+        "p50_us": round(samples[len(samples) // 2] * 1e6, 2),
+        "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 2),
+        "max_us": round(samples[-1] * 1e6, 2),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the game.py rendering and painting hot paths")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, out of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--time", type=float, default=1.0, help="seconds to spend on each benchmark")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved earlier with --save")
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    save = os.path.abspath(args.save) if args.save else None
+    # game.py loads its assets relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    results = {}
+    for name in names:
+        screen = setup()
+        results[name] = measure(BENCHMARKS[name](screen), args.time)
+        pygame.quit()
+        line = f"{name:<20} {results[name]['mean_us']:>12.2f} us/call  p50 {results[name]['p50_us']:>12.2f}" \
+               f"  p99 {results[name]['p99_us']:>12.2f}"
+        if name in baseline:
+            line += f"  x{baseline[name]['mean_us'] / results[name]['mean_us']:.2f} vs baseline"
+        print(line)
+
+    if save:
+        with open(save, "w") as f:
+            json.dump({
+                "revision": git_revision(),
+                "python": sys.version.split()[0],
+                "pygame": pygame.version.ver,
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
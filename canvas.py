@@ -0,0 +1,199 @@
+import struct
+import zlib
+from array import array
+
+CELL_COUNT = 64
+BACKGROUND = (255, 255, 255)
+
+# Snapshots: format, width, height, then the zlib-compressed pixels. An indexed snapshot has
+# the colour count minus one, the colours as r, g, b, then one zlib-compressed colour index per cell.
+SNAPSHOT_HEADER = struct.Struct("!BBB")
+SNAPSHOT_RGB = 0
+SNAPSHOT_INDEXED = 1
+MAX_SNAPSHOT_COLORS = 256
+
+
+def brush_offsets(size):
+    offsets = {(0, 0)}
+    if size == 2:
+        offsets.update([(1, 0), (-1, 0), (0, 1), (0, -1)])
+    elif size == 3:
+        offsets.update([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    elif size == 4:
+        offsets.update([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        offsets.update([(2, 0), (-2, 0), (0, 2), (0, -2)])
+    elif size == 5:
+        offsets.update([(dx, dy) for dx in range(-2, 3) for dy in range(-2, 3)])
+    return tuple(sorted(offsets))
+
+
+BRUSHES = {size: brush_offsets(size) for size in range(1, 6)}
+
+
+def line_cells(points):
+    # Bresenham through every segment of the polyline, shared end points are yielded twice
+    if len(points) == 1:
+        yield points[0]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        err = dx + dy
+        while True:
+            yield x0, y0
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+
+class Canvas:
+    def __init__(self, cell_count=CELL_COUNT, color=BACKGROUND):
+        self.cell_count = cell_count
+        self.color = color
+        self.pixels = bytearray(bytes(color) * (cell_count * cell_count))
+
+    def get_color(self, x, y):
+        idx = (y * self.cell_count + x) * 3
+        return tuple(self.pixels[idx:idx + 3])
+
+    def set_color(self, x, y, color):
+        idx = (y * self.cell_count + x) * 3
+        self.pixels[idx:idx + 3] = bytes(color[:3])
+
+    def paint(self, x, y, r, g, b, size):
+        cell_count = self.cell_count
+        color = bytes((r, g, b))
+        for dx, dy in BRUSHES.get(size, BRUSHES[1]):
+            cx, cy = x + dx, y + dy
+            if cx < 0 or cy < 0 or cx >= cell_count or cy >= cell_count:
+                continue
+            idx = (cy * cell_count + cx) * 3
+            self.pixels[idx:idx + 3] = color
+
+    def line(self, r, g, b, size, points):
+        # Stamp the brush along the stroke, every cell is written once, returns the bounds it changed
+        cell_count = self.cell_count
+        brush = BRUSHES.get(size, BRUSHES[1])
+        cells = {(x + dx, y + dy) for x, y in line_cells(points) for dx, dy in brush}
+        cells = [(x, y) for x, y in cells if 0 <= x < cell_count and 0 <= y < cell_count]
+        if not cells:
+            return None
+        pixels = self.pixels
+        color = bytes((r, g, b))
+        for x, y in cells:
+            idx = (y * cell_count + x) * 3
+            pixels[idx:idx + 3] = color
+        xs = [x for x, _ in cells]
+        ys = [y for _, y in cells]
+        return min(xs), min(ys), max(xs) + 1, max(ys) + 1
+
+    def fill(self, x, y, r, g, b):
+        # Scanline flood fill over 4-connected cells of the seed's colour, returns the bounds it changed
+        cell_count = self.cell_count
+        if x < 0 or y < 0 or x >= cell_count or y >= cell_count:
+            return None
+        pixels = self.pixels
+        idx = (y * cell_count + x) * 3
+        target = bytes(pixels[idx:idx + 3])
+        color = bytes((r, g, b))
+        if target == color:
+            return None
+        target_row = target * cell_count
+        left, top, right, bottom = x, y, x, y
+        stack = [(x, y)]
+        while stack:
+            x, y = stack.pop()
+            row = y * cell_count * 3
+            if pixels[row + x * 3:row + x * 3 + 3] != target:
+                continue
+            if pixels[row:row + cell_count * 3] == target_row:
+                lx, rx = 0, cell_count - 1
+            else:
+                lx = x
+                while lx > 0 and pixels[row + lx * 3 - 3:row + lx * 3] == target:
+                    lx -= 1
+                rx = x
+                while rx < cell_count - 1 and pixels[row + rx * 3 + 3:row + rx * 3 + 6] == target:
+                    rx += 1
+            pixels[row + lx * 3:row + rx * 3 + 3] = color * (rx - lx + 1)
+            left, right = min(left, lx), max(right, rx)
+            top, bottom = min(top, y), max(bottom, y)
+            # Queue one seed per run of matching cells in the rows above and below the span
+            for ny in (y - 1, y + 1):
+                if ny < 0 or ny >= cell_count:
+                    continue
+                nrow = ny * cell_count * 3
+                span = pixels[nrow + lx * 3:nrow + rx * 3 + 3]
+                if span == target * (rx - lx + 1):
+                    stack.append((lx, ny))
+                    continue
+                if span.find(target) == -1:
+                    continue
+                inside = False
+                for cx in range(lx, rx + 1):
+                    if pixels[nrow + cx * 3:nrow + cx * 3 + 3] == target:
+                        if not inside:
+                            stack.append((cx, ny))
+                            inside = True
+                    else:
+                        inside = False
+        return left, top, right + 1, bottom + 1
+
+    def apply(self, op, payload):
+        if op == "PAINT":
+            self.paint(*payload)
+        elif op == "FILL":
+            self.fill(*payload)
+        elif op == "LINE":
+            self.line(*payload)
+
+    def clear(self):
+        self.pixels[:] = bytes(self.color) * (self.cell_count * self.cell_count)
+
+    def snapshot(self, indexed=True):
+        pixels = bytes(self.pixels)
+        if indexed:
+            # Widen every cell to one int, so finding and numbering the colours runs in C
+            cells = bytearray(len(pixels) // 3 * 4)
+            for channel in range(3):
+                cells[channel::4] = pixels[channel::3]
+            cells = array("I", cells)
+            colors = {color: index for index, color in enumerate(dict.fromkeys(cells))}
+            if len(colors) <= MAX_SNAPSHOT_COLORS:
+                widened = array("I", colors).tobytes()
+                palette = bytearray(len(colors) * 3)
+                for channel in range(3):
+                    palette[channel::3] = widened[channel::4]
+                header = SNAPSHOT_HEADER.pack(SNAPSHOT_INDEXED, self.cell_count, self.cell_count)
+                return header + bytes((len(colors) - 1,)) + palette + zlib.compress(bytes(map(colors.get, cells)))
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_RGB, self.cell_count, self.cell_count)
+        return header + zlib.compress(pixels)
+
+    def load_snapshot(self, data):
+        fmt, width, height = SNAPSHOT_HEADER.unpack_from(data)
+        if fmt not in (SNAPSHOT_RGB, SNAPSHOT_INDEXED) or width != self.cell_count or height != self.cell_count:
+            raise ValueError(f"Unsupported snapshot format {fmt} ({width}x{height})")
+        body = data[SNAPSHOT_HEADER.size:]
+        if fmt == SNAPSHOT_RGB:
+            pixels = zlib.decompress(body)
+        else:
+            start = 1 + (body[0] + 1) * 3
+            widened = bytearray((body[0] + 1) * 4)
+            for channel in range(3):
+                widened[channel::4] = body[1 + channel:start:3]
+            colors = array("I", widened)
+            try:
+                cells = array("I", map(colors.__getitem__, zlib.decompress(body[start:]))).tobytes()
+            except IndexError:
+                raise ValueError("Snapshot refers to a colour it does not have")
+            pixels = bytearray(len(cells) // 4 * 3)
+            for channel in range(3):
+                pixels[channel::3] = cells[channel::4]
+        if len(pixels) != len(self.pixels):
+            raise ValueError(f"Snapshot has {len(pixels)} bytes of pixels instead of {len(self.pixels)}")
+        self.pixels[:] = pixels
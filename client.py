@@ -1,90 +1,295 @@
+import argparse
 import socket
 import threading
+import time
+from array import array
+from collections import deque
 import game
+import protocol
 import re
 import tkinter as tk
-from queue import Queue
+from queue import Empty, Queue
 
 APP_WIDTH, APP_HEIGHT = 400, 770
 CHAT_FONT = ("微軟正黑體", 12)
 GLOBAL_FONT = ("Consolas", 16)
 IP_REGEX = r"\d{1,3}(\.\d{1,3}){3}"
 PORT_REGEX = r"\d{4,5}"
-NAME_REGEX = r"[a-zA-Z0-9_]+"
+NAME_REGEX = r"[a-zA-Z0-9_]{1,32}"
+# Seconds to keep trying to resume a dropped session, like the server's --resume-grace
+RESUME_WINDOW = 30
+RESUME_RETRY = 1
+DRAW_OPS = ("PAINT", "FILL", "LINE")
+# Milliseconds between drains of the network thread's messages, and lines kept per message box
+PUMP_INTERVAL = 50
+MAX_SCROLLBACK = 500
 
 app = tk.Tk()
 client: socket.socket = None
+packet_reader = protocol.PacketReader()
+# Outlives the connection, the server sends the whole table again after a resume
+color_table = protocol.ColorTable()
 connect_parameters = {
     "host": "127.0.0.1",
     "port": "48763",
-    "name": "Kirito"
+    "name": "Kirito",
+    "room": ""
 }
 game_msg_queue = Queue()
+# Chat and game messages for the Tk main loop, the socket thread must not touch widgets
+tk_msg_queue = Queue()
+game_options = {
+    "max_fps": game.MAX_FPS
+}
+# Printing every read copies and formats it, so it is only done when asked for
+debug_options = {
+    "log_packets": False
+}
+# resets counts the CLEARs and snapshots received, step the draw ops since the last one
+# binary is the send mode, a resumed session sends binary right after RESUME like the server expects
+session = {
+    "token": None,
+    "resets": 0,
+    "step": 0,
+    "resuming": False,
+    "binary": False
+}
 
 tk_elements = {}
 has_focus = {}
 score_dict = {}
+# Rows shown under the scoreboard header, and whether a redraw is already scheduled
+scoreboard_view = {
+    "rows": None,
+    "pending": False
+}
+
+
+class GameConnection:
+    # The game window outlives resumed connections, so it always talks through the current socket
+    def sendall(self, data):
+        try:
+            client.sendall(data)
+        except OSError:
+            # Strokes are lost while reconnecting, the painter gets a snapshot once resumed
+            pass
+
+    def fileno(self):
+        return client.fileno()
+
+    def close(self):
+        close_session()
 
 
 def threaded_socket():
     print("[Client] Socket thread created")
-    global client
+    while receive() and resume():
+        print("[Client] Reconnected, resuming the session")
+    client.close()
+    # Let the game loop notice the closed connection
+    game.wake()
+    print(f"[Client] Disconnected from server")
+
+
+def receive():
     while True:
         try:
-            msg = str(client.recv(4096), encoding='utf-8')
-            if msg:
-                print(f"[From server]: {msg}")
-                packets = msg.split("@")
-                for packet in packets:
-                    data = packet.split(",", 1)
-                    if data[0] == "G":
-                        game_msg_queue.put(data[1])
-                    elif data[0] == "N":
-                        pkt_type, payload = data[1].split(",", 1)
-                        decode_packet(pkt_type, payload)
-                    elif data[0] == "C":
-                        if "chat_message" in tk_elements:
-                            insert_message(tk_elements["chat_message"], data[1] + "\n")
+            size = client.recv_into(packet_reader.writable())
+            if size:
+                data = packet_reader.commit(size)
+                if debug_options["log_packets"]:
+                    print(f"[From server]: {bytes(data)}")
+                batch = array("B")
+                queued = False
+                for channel, pkt_type, payload in packet_reader.packets():
+                    if channel == "G":
+                        packet = color_table.expand(pkt_type, payload)
+                        if packet is None:
+                            continue
+                        pkt_type, payload = packet
+                        count_step(pkt_type)
+                    if channel == "G" and game.add_stamps(batch, pkt_type, payload):
+                        continue
+                    if batch:
+                        game_msg_queue.put(("STAMPS", batch))
+                        queued = True
+                        batch = array("B")
+                    if channel == "G":
+                        game_msg_queue.put((pkt_type, payload))
+                        queued = True
+                    elif channel == "N":
+                        if decode_session_packet(pkt_type, payload):
+                            tk_msg_queue.put((channel, pkt_type, payload))
+                    elif channel == "C":
+                        tk_msg_queue.put((channel, pkt_type, payload))
+                if batch:
+                    game_msg_queue.put(("STAMPS", batch))
+                    queued = True
+                if queued:
+                    game.wake()
             else:
-                break
+                return True
+        except ConnectionError:
+            return True
         except Exception as e:
             print(f'[Client] Error handling message from server: {e}')
+            return False
+
+
+def count_step(pkt_type):
+    if pkt_type in DRAW_OPS:
+        session["step"] += 1
+    elif pkt_type in ("CLEAR", "SNAPSHOT"):
+        session["resets"] += 1
+        session["step"] = 0
+
+
+def resume():
+    global client, packet_reader
+    if session["token"] is None:
+        return False
+    print(f"[Client] Lost connection, trying to resume for {RESUME_WINDOW} seconds")
+    address = (connect_parameters["host"], int(connect_parameters["port"]))
+    deadline = time.monotonic() + RESUME_WINDOW
+    while session["token"] is not None and time.monotonic() < deadline:
+        try:
+            sock = socket.create_connection(address, timeout=RESUME_RETRY)
+        except OSError:
+            time.sleep(RESUME_RETRY)
+            continue
+        sock.settimeout(None)
+        packet_reader = protocol.PacketReader()
+        session["resuming"] = True
+        sock.sendall(protocol.encode_packet("G", "RESUME", f"{session['token']},{protocol.PROTOCOL_VERSION},"
+                                                           f"{session['resets']},{session['step']}"))
+        # The old socket stays open until here, so the game window keeps running meanwhile
+        client, old = sock, client
+        old.close()
+        return True
+    return False
+
+
+def decode_session_packet(pkt_type, payload):
+    # Runs on the socket thread before the next packet is parsed, returns whether Tk should see the packet too
+    if pkt_type == "WELCOME":
+        version = int(payload) if payload else protocol.TEXT_VERSION
+        packet_reader.binary = session["binary"] = version >= protocol.BINARY_VERSION
+        if session["resuming"]:
+            session["resuming"] = False
+            return False
+    elif pkt_type == "SESSION":
+        session["token"] = payload
+        return False
+    elif pkt_type == "EXPIRED":
+        session["token"] = None
+        # The receive loop then sees EOF and gives up, there is nothing left to resume
+        client.shutdown(socket.SHUT_RDWR)
+    return True
+
+
+def pump_messages():
+    # Drain everything that arrived since the last call, only the lines that stay in the scrollback are inserted.
+    # Scheduled first, so a packet that fails to decode cannot stop the pump.
+    app.after(PUMP_INTERVAL, pump_messages)
+    lines = {"game_message": deque(maxlen=MAX_SCROLLBACK), "chat_message": deque(maxlen=MAX_SCROLLBACK)}
+    while True:
+        try:
+            channel, pkt_type, payload = tk_msg_queue.get_nowait()
+        except Empty:
             break
-    client.close()
-    print(f"[Client] Disconnected from server")
+        if channel == "C":
+            lines["chat_message"].append(payload + "\n")
+        elif pkt_type == "INFO":
+            lines["game_message"].append(payload + "\n")
+        elif pkt_type == "EXPIRED":
+            lines["game_message"].append("[系統] 連線已逾時，請重新加入遊戲\n")
+        else:
+            try:
+                decode_packet(pkt_type, payload)
+            except Exception as e:
+                print(f"[Client] Error handling {pkt_type} packet: {e}")
+    for name, text in lines.items():
+        if text and name in tk_elements:
+            try:
+                append_lines(tk_elements[name], text)
+            except Exception as e:
+                print(f"[Client] Error showing messages in {name}: {e}")
+
+
+def append_lines(box, lines):
+    box.config(state=tk.NORMAL)
+    box.insert(tk.END, "".join(lines))
+    # The box keeps the last MAX_SCROLLBACK lines, end-1c sits on the empty line after the last one
+    excess = int(box.index("end-1c").split(".")[0]) - 1 - MAX_SCROLLBACK
+    if excess > 0:
+        box.delete("1.0", f"{excess + 1}.0")
+    box.see(tk.END)
+    box.config(state=tk.DISABLED)
 
 
 def decode_packet(pkt_type, payload):
-    if pkt_type == "INFO":
-        if "game_message" in tk_elements:
-            insert_message(tk_elements["game_message"], payload + "\n")
+    if pkt_type == "ROSTER":
+        score_dict.clear()
+        update_scores(payload)
     elif pkt_type == "SCORE":
-        name, score = payload.split(",")
-        if score == "-1":
-            score_dict.pop(name)
-        else:
-            score_dict[name] = score
-        update_scoreboard()
+        update_scores(payload)
     elif pkt_type == "WELCOME":
         enter_game_chat()
     elif pkt_type == "DUPNAME":
         insert_message(tk_elements["response_message"], "", True)
         insert_message(tk_elements["response_message"], "Name has already been used. Please choose a new name.")
+    elif pkt_type == "BADNAME":
+        insert_message(tk_elements["response_message"], "", True)
+        insert_message(tk_elements["response_message"],
+                       "Name and room can only contain up to 32 english letters, numbers and underscores.")
+    elif pkt_type == "ROOMFULL":
+        insert_message(tk_elements["response_message"], "", True)
+        insert_message(tk_elements["response_message"], "The room is full. Please choose another room.")
+
+
+def update_scores(payload):
+    for entry in payload.split(";") if payload else ():
+        name, score = entry.split(",")
+        if score == "-1":
+            score_dict.pop(name, None)
+        else:
+            score_dict[name] = score
+    update_scoreboard()
 
 
 def update_scoreboard():
+    # However many score packets arrive at once, the scoreboard is redrawn once when Tk is idle
+    if scoreboard_view["pending"]: return
+    scoreboard_view["pending"] = True
+    app.after_idle(redraw_scoreboard)
+
+
+def scoreboard_row(name, score):
+    return name + " " * max(15 - len(name), 1) + " " * max(5 - len(str(score)), 1) + score
+
+
+def redraw_scoreboard():
+    scoreboard_view["pending"] = False
     if "scoreboard" not in tk_elements: return
     box = tk_elements["scoreboard"]
-    insert_message(box, "", True)
+    rows = [scoreboard_row(name, score) for name, score in sorted(score_dict.items(), key=lambda x: (-int(x[1]), x[0]))]
+    shown = scoreboard_view["rows"]
     box.config(state=tk.NORMAL)
-    box.insert(tk.END, f"Name" + " " * max(15 - len("Name"), 1) + "Score\n")
-    for name, score in sorted(score_dict.items(), key=lambda x: (-int(x[1]), x[0])):
-        line = name
-        line += " " * max(15 - len(name), 1)
-        line += " " * max(5 - len(str(score)), 1)
-        line += score
-        box.insert(tk.END, line + "\n")
+    if shown is None:
+        box.delete('1.0', tk.END)
+        box.insert(tk.END, f"Name" + " " * max(15 - len("Name"), 1) + "Score\n")
+        shown = []
+    # Only rewrite the rows that changed, row i is on line i + 2 below the header
+    for index, row in enumerate(rows):
+        if index >= len(shown):
+            box.insert(tk.END, row + "\n")
+        elif row != shown[index]:
+            box.delete(f"{index + 2}.0", f"{index + 2}.end")
+            box.insert(f"{index + 2}.0", row)
+    if len(shown) > len(rows):
+        box.delete(f"{len(rows) + 2}.0", tk.END)
     box.config(state=tk.DISABLED)
+    scoreboard_view["rows"] = rows
 
 
 def insert_message(entry, message, clear=False):
@@ -95,20 +300,34 @@ def insert_message(entry, message, clear=False):
     entry.config(state=tk.DISABLED)
 
 
+def send_packet(channel, pkt_type, payload=""):
+    client.sendall(protocol.encode_packet(channel, pkt_type, payload, session["binary"]))
+
+
 def send_game_message(entry):
-    client.sendall(f"N,GUESS,{entry.get()}".encode())
+    send_packet("N", "GUESS", entry.get())
     insert_message(entry, "", True)
     entry.config(state=tk.NORMAL)
 
 
 def send_chat_message(entry):
-    client.sendall(f"C,{entry.get()}".encode())
+    send_packet("C", None, entry.get())
     insert_message(entry, "", True)
     entry.config(state=tk.NORMAL)
 
 
+def close_session():
+    session["token"] = None
+    # close() alone does not wake the socket thread blocked in recv
+    try:
+        client.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    client.close()
+
+
 def app_close():
-    if client is not None: client.close()
+    if client is not None: close_session()
     app.destroy()
 
 
@@ -125,14 +344,16 @@ def check_connect_params():
     if not re.fullmatch(PORT_REGEX, connect_parameters["port"]):
         errors.append("Invalid port. Please check your input.")
     if not re.fullmatch(NAME_REGEX, connect_parameters["name"]):
-        errors.append("Name can only contain english letters, numbers and underscores.")
+        errors.append("Name can only contain up to 32 english letters, numbers and underscores.")
+    if connect_parameters["room"] and not re.fullmatch(NAME_REGEX, connect_parameters["room"]):
+        errors.append("Room can only contain up to 32 english letters, numbers and underscores.")
     return errors
 
 
 def threaded_game_client():
     global client
     print("[Client] Starting game client")
-    game.main(game_msg_queue, client)
+    game.main(game_msg_queue, GameConnection(), session["binary"], game_options["max_fps"])
     print("[Client] Game client terminated")
 
 
@@ -145,7 +366,7 @@ def connect():
         return
     host = connect_parameters["host"]
     port = int(connect_parameters["port"])
-    global client
+    global client, packet_reader
     print(f"[Client] Connecting to {(host, port)}...")
     try:
         if client is None or client.fileno() == -1:
@@ -153,9 +374,11 @@ def connect():
             client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             client.connect((host, port))
             print(f"[Client] Connected to {(host, port)}")
+            packet_reader = protocol.PacketReader()
+            session.update(token=None, resets=0, step=0, resuming=False, binary=False)
             socket_thread = threading.Thread(target=threaded_socket)
             socket_thread.start()
-        client.sendall(f"G,JOIN,{connect_parameters['name']}".encode())
+        send_packet("G", "JOIN", f"{connect_parameters['name']},{protocol.PROTOCOL_VERSION},{connect_parameters['room']}")
     except Exception as e:
         print(f'[Client] Error connecting the server: {e}')
         insert_message(tk_elements["response_message"], "", True)
@@ -183,6 +406,14 @@ def set_focus(widget, focus):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="SoulPainter client")
+    parser.add_argument("--fps", type=int, default=game.MAX_FPS,
+                        help="frame cap while drawing, the game window sleeps until something happens otherwise")
+    parser.add_argument("--log-packets", action="store_true", help="print every read from the server")
+    args = parser.parse_args()
+    game_options["max_fps"] = args.fps
+    debug_options["log_packets"] = args.log_packets
+
     app.title("SoulPainter Chat Client")
     app.geometry("%dx%d" % (APP_WIDTH, APP_HEIGHT))
 
@@ -204,7 +435,7 @@ def main():
     header_label.pack(side=tk.TOP, pady=(50, 0))
 
     ip_label = tk.Label(lobby_frame, font=("Consolas", 16), text="Server IP")
-    ip_label.pack(side=tk.TOP, pady=(50, 0))
+    ip_label.pack(side=tk.TOP, pady=(40, 0))
 
     ip_entry = tk.Entry(lobby_frame,
                         width=15,
@@ -217,7 +448,7 @@ def main():
     ip_entry.bind("<KeyRelease>", lambda event: set_connect_params('host', event.widget.get()))
 
     port_label = tk.Label(lobby_frame, font=("Consolas", 16), text="Port")
-    port_label.pack(side=tk.TOP, pady=(50, 0))
+    port_label.pack(side=tk.TOP, pady=(40, 0))
 
     port_entry = tk.Entry(lobby_frame,
                           width=10,
@@ -230,7 +461,7 @@ def main():
     port_entry.bind("<KeyRelease>", lambda event: set_connect_params('port', event.widget.get()))
 
     name_label = tk.Label(lobby_frame, font=("Consolas", 16), text="Nickname")
-    name_label.pack(side=tk.TOP, pady=(50, 0))
+    name_label.pack(side=tk.TOP, pady=(40, 0))
 
     name_entry = tk.Entry(lobby_frame,
                           width=10,
@@ -242,6 +473,19 @@ def main():
     name_entry.bind('<FocusOut>', lambda event: set_focus('name', False))
     name_entry.bind("<KeyRelease>", lambda event: set_connect_params('name', event.widget.get()))
 
+    room_label = tk.Label(lobby_frame, font=("Consolas", 16), text="Room (empty for matchmaking)")
+    room_label.pack(side=tk.TOP, pady=(30, 0))
+
+    room_entry = tk.Entry(lobby_frame,
+                          width=10,
+                          highlightbackground="black", highlightthickness=1,
+                          font=GLOBAL_FONT)
+    room_entry.pack(side=tk.TOP, pady=(10, 0))
+    room_entry.insert(tk.END, f"{connect_parameters['room']}")
+    room_entry.bind('<FocusIn>', lambda event: set_focus('room', True))
+    room_entry.bind('<FocusOut>', lambda event: set_focus('room', False))
+    room_entry.bind("<KeyRelease>", lambda event: set_connect_params('room', event.widget.get()))
+
     connect_btn = tk.Button(lobby_frame,
                             font=GLOBAL_FONT,
                             text="Link Start",
@@ -317,6 +561,7 @@ def main():
     enter_lobby()
 
     app.protocol("WM_DELETE_WINDOW", app_close)
+    app.after(PUMP_INTERVAL, pump_messages)
     app.resizable(False, False)
     app.mainloop()
 
@@ -1,17 +1,37 @@
 import pygame
 import colorsys
+import functools
+import canvas
+from array import array
+import protocol
 from queue import Queue
 from enum import IntEnum
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 MAX_FPS = 240
 SCREEN_WIDTH, SCREEN_HEIGHT = 1080, 770
-NEIGHBORS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
 TIMER_EVENT = pygame.USEREVENT + 1
+NETWORK_EVENT = pygame.USEREVENT + 2
+# Milliseconds an idle client sleeps at most before looking at the connection again
+IDLE_WAIT = 1000
+PALETTE_SIZE = 200
+PALETTE_CACHE_SIZE = 64
+TEXT_CACHE_SIZE = 256
+ICON_SIZE = 22
+BRUSH_REACH = max(max(abs(dx), abs(dy)) for offsets in canvas.BRUSHES.values() for dx, dy in offsets)
 
 tools = {}
 sliders = {}
 display = {}
 game_variables = {}
+dirty_rects = []
+
+if numpy is not None:
+    BRUSH_ARRAYS = {size: numpy.array(offsets) for size, offsets in canvas.BRUSHES.items()}
 
 
 def remap(oldLow, oldHigh, newLow, newHigh, value):
@@ -21,12 +41,32 @@ def remap(oldLow, oldHigh, newLow, newHigh, value):
     return max(newLow, min(newHigh, newVal))
 
 
-def neighbors(x, y, directions=4, step=1):
-    pos = []
-    for dx, dy in NEIGHBORS[:directions]:
-        for s in range(1, step + 1):
-            pos.append((x + dx * s, y + dy * s))
-    return pos
+def mark_dirty(rect):
+    dirty_rects.append(pygame.Rect(rect))
+
+
+def update_display():
+    # Only push the regions drawn since the last update to the screen
+    if dirty_rects:
+        pygame.display.update(dirty_rects)
+        dirty_rects.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(name, size):
+    return pygame.font.SysFont(name, size)
+
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(text, color, size=20, name="Consolas"):
+    return get_font(name, size).render(text, True, color)
+
+
+def clear_render_cache():
+    # Fonts and the surfaces rendered with them do not survive pygame.quit()
+    get_font.cache_clear()
+    render_text.cache_clear()
+    palette_surface.cache_clear()
 
 
 def draw_walls(screen):
@@ -54,59 +94,169 @@ def draw_walls(screen):
 
 def draw_current_color(screen):
     color = game_variables["selected_color"]
-    pygame.draw.rect(screen, (235, 235, 235), (905, 620, 40, 40))
+    if color == display.get("current_color"):
+        return
+    display["current_color"] = color
+    mark_dirty(pygame.draw.rect(screen, (235, 235, 235), (905, 620, 40, 40)))
     pygame.draw.rect(screen, color, (910, 625, 30, 30))
 
 
-def draw_palette(screen):
-    hue = sliders["hue"].slide_val
+def hls_to_rgb(h, l, s):
+    # colorsys.hls_to_rgb over whole arrays, scaled to 0-255 like int(255 * c)
+    h, l, s = numpy.asarray(h, dtype=float), numpy.asarray(l, dtype=float), numpy.asarray(s, dtype=float)
+    m2 = numpy.where(l <= 0.5, l * (1.0 + s), l + s - (l * s))
+    m1 = 2.0 * l - m2
+    # Per channel, how far each hue is from m1 towards m2, this only depends on the hue
+    hue = (h[..., None] + numpy.array([1 / 3, 0.0, -1 / 3])) % 1.0
+    weight = numpy.select([hue < 1 / 6, hue < 0.5, hue < 2 / 3], [hue * 6.0, 1.0, (2 / 3 - hue) * 6.0], 0.0)
+    rgb = m1[..., None] + (m2 - m1)[..., None] * weight
+    return (rgb * 255).astype(numpy.uint8)
 
-    pygame.draw.rect(screen, (235, 235, 235), (810, 290, 220, 220))
-    palette = display['palette']
 
-    for x in range(200):
-        for y in range(200):
-            palette.set_at((x, y), tuple(int(255 * i) for i in colorsys.hls_to_rgb(hue / 360, 1 - y / 200, x / 200)))
-    screen.blit(palette, (820, 300))
+def render_gradient(size, color_at):
+    surface = pygame.Surface(size)
+    for x in range(size[0]):
+        for y in range(size[1]):
+            surface.set_at((x, y), color_at(x, y))
+    return surface
 
 
-class ColorGrid:
-    class ColorCell:
-        def __init__(self, pos, size, color):
-            self.pos = pos
-            self.size = size
-            self.color = color
-            self.subsurface = pygame.Surface((self.size, self.size))
-            self.subsurface.fill(self.color)
+@functools.lru_cache(maxsize=PALETTE_CACHE_SIZE)
+def palette_surface(hue):
+    # Saturation grows to the right and lightness falls downwards
+    if numpy is None:
+        return render_gradient((PALETTE_SIZE, PALETTE_SIZE), lambda x, y: tuple(
+            int(255 * i) for i in colorsys.hls_to_rgb(hue / 360, 1 - y / PALETTE_SIZE, x / PALETTE_SIZE)))
+    steps = numpy.arange(PALETTE_SIZE) / PALETTE_SIZE
+    return pygame.surfarray.make_surface(hls_to_rgb(hue / 360, 1 - steps[None, :], steps[:, None]))
 
-        def change_color(self, new_color):
-            self.color = new_color
-            self.subsurface.fill(self.color)
 
-        def draw(self, screen):
-            screen.blit(self.subsurface, self.pos)
+def hue_bar_surface(width, height):
+    if numpy is None:
+        return render_gradient((width, height), lambda x, y: tuple(
+            int(255 * i) for i in colorsys.hls_to_rgb(x / width, 0.5, 1)))
+    column = hls_to_rgb(numpy.arange(width) / width, 0.5, 1)
+    return pygame.surfarray.make_surface(numpy.repeat(column[:, None, :], height, axis=1))
+
+
+def draw_palette(screen):
+    hue = sliders["hue"].slide_val
 
+    mark_dirty(pygame.draw.rect(screen, (235, 235, 235), (810, 290, 220, 220)))
+    palette = palette_surface(hue)
+    display['palette'] = palette
+    screen.blit(palette, (820, 300))
+
+
+class ColorGrid:
     def __init__(self, pos, cell_count, cell_size, color):
         self.pos = pos
         self.cell_count = cell_count
         self.cell_size = cell_size
         self.color = color
-        self.grid = [[ColorGrid.ColorCell(pos=(self.pos[0] + self.cell_size * j, self.pos[1] + self.cell_size * i),
-                                          size=self.cell_size,
-                                          color=self.color) for i in range(cell_count)] for j in range(cell_count)]
-
-    def __getitem__(self, idx):
-        return self.grid[idx]
-
-    def draw(self, screen):
-        for row in self.grid:
-            for cell in row:
-                cell.draw(screen)
+        # One RGB byte per channel and cell, the surface reads the canvas pixels in place
+        self.canvas = canvas.Canvas(cell_count, color)
+        self.surface = pygame.image.frombuffer(self.canvas.pixels, (cell_count, cell_count), "RGB")
+        self.scaled = pygame.Surface((cell_count * cell_size, cell_count * cell_size), 0, self.surface)
+        self.rect = self.scaled.get_rect(topleft=self.pos)
+        # Bounds (left, top, right, bottom) of the cells changed since the last rescale
+        self.dirty = None
+        self.touch(0, 0, cell_count, cell_count)
+
+    def touch(self, left, top, right, bottom):
+        if self.dirty is None:
+            self.dirty = [left, top, right, bottom]
+            return
+        dirty = self.dirty
+        if left < dirty[0]: dirty[0] = left
+        if top < dirty[1]: dirty[1] = top
+        if right > dirty[2]: dirty[2] = right
+        if bottom > dirty[3]: dirty[3] = bottom
+
+    def get_color(self, x, y):
+        return self.canvas.get_color(x, y)
+
+    def set_color(self, x, y, color):
+        self.canvas.set_color(x, y, color)
+        self.touch(x, y, x + 1, y + 1)
+
+    def paint(self, x, y, color, size):
+        self.canvas.paint(x, y, *color[:3], size)
+        self.touch(x - BRUSH_REACH, y - BRUSH_REACH, x + BRUSH_REACH + 1, y + BRUSH_REACH + 1)
+
+    def line(self, points, color, size):
+        bounds = self.canvas.line(*color[:3], size, points)
+        if bounds is not None:
+            self.touch(*bounds)
+
+    def stamp(self, batch):
+        # Apply a batch of x, y, r, g, b, size records as if each were painted in order
+        if numpy is None:
+            for i in range(0, len(batch), 6):
+                x, y, r, g, b, size = batch[i:i + 6]
+                self.paint(x, y, (r, g, b), size)
+            return
+        ops = numpy.frombuffer(batch, dtype=numpy.uint8).reshape(-1, 6).astype(numpy.intp)
+        sizes = numpy.where(numpy.isin(ops[:, 5], list(BRUSH_ARRAYS)), ops[:, 5], 1)
+        xs, ys, order = [], [], []
+        for size, offsets in BRUSH_ARRAYS.items():
+            idx = numpy.flatnonzero(sizes == size)
+            if len(idx) == 0:
+                continue
+            xs.append((ops[idx, 0, None] + offsets[:, 0]).ravel())
+            ys.append((ops[idx, 1, None] + offsets[:, 1]).ravel())
+            order.append(numpy.repeat(idx, len(offsets)))
+        xs, ys, order = numpy.concatenate(xs), numpy.concatenate(ys), numpy.concatenate(order)
+        inside = (xs >= 0) & (ys >= 0) & (xs < self.cell_count) & (ys < self.cell_count)
+        xs, ys, order = xs[inside], ys[inside], order[inside]
+        if len(order) == 0:
+            return
+        # The last op to cover a cell decides its colour
+        cells = (ys * self.cell_count + xs)[numpy.argsort(order, kind="stable")[::-1]]
+        cells, first = numpy.unique(cells, return_index=True)
+        last_ops = numpy.sort(order)[::-1][first]
+        pixels = numpy.frombuffer(self.canvas.pixels, dtype=numpy.uint8).reshape(-1, 3)
+        pixels[cells] = ops[last_ops, 2:5]
+        self.touch(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+    def fill(self, x, y, color):
+        bounds = self.canvas.fill(x, y, *color[:3])
+        if bounds is not None:
+            self.touch(*bounds)
+
+    def update(self):
+        # Rescale only the changed cells and return the screen area they cover
+        if self.dirty is None:
+            return None
+        left, top, right, bottom = self.dirty
+        self.dirty = None
+        cells = pygame.Rect(left, top, right - left, bottom - top).clip(self.surface.get_rect())
+        if cells.width == 0 or cells.height == 0:
+            return None
+        area = pygame.Rect(cells.x * self.cell_size, cells.y * self.cell_size,
+                           cells.width * self.cell_size, cells.height * self.cell_size)
+        pygame.transform.scale(self.surface.subsurface(cells), area.size, self.scaled.subsurface(area))
+        return area.move(self.pos)
+
+    def draw(self, screen, area=None):
+        self.update()
+        area = self.rect if area is None else self.rect.clip(area)
+        screen.blit(self.scaled, area.topleft, area.move(-self.pos[0], -self.pos[1]))
+        mark_dirty(area)
+
+    def draw_changes(self, screen):
+        area = self.update()
+        if area is not None:
+            screen.blit(self.scaled, area.topleft, area.move(-self.pos[0], -self.pos[1]))
+            mark_dirty(area)
 
     def clean(self):
-        for row in self.grid:
-            for cell in row:
-                cell.change_color(self.color)
+        self.canvas.clear()
+        self.touch(0, 0, self.cell_count, self.cell_count)
+
+    def load_snapshot(self, snapshot):
+        self.canvas.load_snapshot(snapshot)
+        self.touch(0, 0, self.cell_count, self.cell_count)
 
 
 class Component:
@@ -129,19 +279,20 @@ class Slider(Component):
         super().__init__(pos, width, height, surface_color)
         self.slide_val = 0
         self.val_min, self.val_max = val_range
-        self.font = pygame.font.SysFont("Consolas", font_size)
-        self.text_render = self.font.render(text, True, font_color)
-        self.val_render = self.font.render(str(self.slide_val), True, (30, 30, 30))
+        self.font_size = font_size
+        self.text_render = render_text(text, tuple(font_color), font_size)
+        self.val_render = render_text(str(self.slide_val), (30, 30, 30), font_size)
         self.slide_bar = pygame.Surface((180, self.height // 2))
 
     def draw(self, screen):
         initX, initY = self.init_pos
         self.slide_val = remap(-90, 90, self.val_min, self.val_max, (self.pos[0] - initX))
-        self.val_render = self.font.render(str(self.slide_val), True, (30, 30, 30))
+        self.val_render = render_text(str(self.slide_val), (30, 30, 30), self.font_size)
 
         # draw the background surface for slide val
         surface_width = 240
-        pygame.draw.rect(screen, (190, 190, 190), (initX - surface_width // 2, initY - 30, surface_width, 60))
+        background = (initX - surface_width // 2, initY - 30, surface_width, 60)
+        mark_dirty(pygame.draw.rect(screen, (190, 190, 190), background))
 
         # draw the long bar [==========]
         pygame.draw.rect(screen, (140, 140, 140), (initX - 80, initY + self.height // 3, 180, self.height // 2))
@@ -162,7 +313,8 @@ class ColorSlider(Component):
         super().__init__(pos, width, height, surface_color)
         self.val_min, self.val_max = val_range
         self.slide_val = remap(-90, 90, self.val_min, self.val_max, 0)
-        self.slide_bar = pygame.Surface((180, self.height // 2))
+        # The hue bar never changes, so it is rendered once
+        self.slide_bar = hue_bar_surface(180, self.height // 2)
 
     def draw(self, screen):
         initX, initY = self.init_pos
@@ -170,13 +322,10 @@ class ColorSlider(Component):
 
         # draw the background surface for slide val
         surface_width = 240
-        pygame.draw.rect(screen, (190, 190, 190), (initX - surface_width // 2, initY - 10, surface_width, 40))
+        background = (initX - surface_width // 2, initY - 10, surface_width, 40)
+        mark_dirty(pygame.draw.rect(screen, (190, 190, 190), background))
 
         # draw the long bar [==========]
-        for i in range(180):
-            for j in range(self.height // 2):
-                self.slide_bar.set_at((i, j),
-                                      tuple(int(255 * i) for i in colorsys.hls_to_rgb(i / 180, 0.5, 1)))
         screen.blit(self.slide_bar, (initX - 80, initY + self.height // 3))
 
         # draw the subsurface behind the slide_val
@@ -211,6 +360,7 @@ class ToolType(IntEnum):
 class PaintTool:
     def __init__(self, icon_path, bind_key, button):
         self.icon = pygame.transform.scale(pygame.image.load(f"assets/{icon_path}"), (100, 100))
+        self.small_icon = pygame.transform.scale(self.icon, (ICON_SIZE, ICON_SIZE))
         self.bind_key = bind_key
         self.button = button
 
@@ -242,56 +392,93 @@ def switch_tool():
         sliders["brush"].pos[0] = sliders["brush"].init_pos[0] + int(180 / 5) * game_variables["brush_size"] - 90
 
 
-def fill(pos, cur_color, fill_color):
-    grid = display["grid"]
-    cell_count = grid.cell_count
-    visited = set()
+def fill(grid_pos, color):
+    display["grid"].fill(*grid_pos, color)
 
-    q = Queue()
-    q.put(pos)
-    while not q.empty():
-        x, y = q.get()
-        if x < 0 or y < 0 or x >= cell_count or y >= cell_count:
-            continue
-        if grid[x][y].color != cur_color:
-            continue
-        if (x, y) in visited:
-            continue
-        visited.add((x, y))
-        grid[x][y].change_color(fill_color)
-        for nx, ny in neighbors(x, y):
-            if (nx, ny) not in visited:
-                q.put((nx, ny))
 
-
-def paint(pos, color, size):
-    posX, posY = pos
+def to_grid_pos(pos):
     grid = display["grid"]
     cell_count = grid.cell_count
     cell_size = grid.cell_size
+    return (remap(0, cell_count * cell_size, 0, cell_count, pos[0]),
+            remap(0, cell_count * cell_size, 0, cell_count, pos[1]))
+
+
+def paint(pos, color, size):
+    paint_cells(to_grid_pos(pos), color, size)
 
-    gridX = remap(0, cell_count * cell_size, 0, cell_count, posX)
-    gridY = remap(0, cell_count * cell_size, 0, cell_count, posY)
-
-    positions = set()
-    positions.add((gridX, gridY))
-    if size == 2:
-        positions.update(neighbors(gridX, gridY, directions=4))
-    elif size == 3:
-        positions.update(neighbors(gridX, gridY, directions=8))
-    elif size == 4:
-        positions.update(neighbors(gridX, gridY, directions=4, step=2))
-        positions.update(neighbors(gridX, gridY, directions=8))
-    elif size == 5:
-        offsets = [0, -1, 1, -2, 2]
-        for dx in offsets:
-            for dy in offsets:
-                positions.add((gridX + dx, gridY + dy))
-
-    for x, y in positions:
-        if x < 0 or y < 0 or x >= cell_count or y >= cell_count:
+
+def paint_cells(grid_pos, color, size):
+    # The grid stamps with the server canvas brushes, so every replica paints the same cells
+    display["grid"].paint(*grid_pos, color, size)
+
+
+def add_stamps(batch, pkt_type, payload):
+    # Strokes become x, y, r, g, b, size records that ColorGrid.stamp applies a frame at a time
+    try:
+        if pkt_type == "PAINT":
+            records = array("B", payload)
+        elif pkt_type == "LINE":
+            r, g, b, size, points = payload
+            records = array("B", [v for x, y in canvas.line_cells(points) for v in (x, y, r, g, b, size)])
+        else:
+            return False
+    except OverflowError:
+        # Out of range for a byte, leave it to decode_packet
+        return False
+    batch.extend(records)
+    return True
+
+
+def apply_messages(msg_queue, conn, screen):
+    batch = array("B")
+    while not msg_queue.empty():
+        pkt_type, payload = msg_queue.get()
+        if pkt_type == "STAMPS":
+            batch.extend(payload)
             continue
-        grid[x][y].change_color(color)
+        if batch:
+            display["grid"].stamp(batch)
+            batch = array("B")
+        decode_packet(conn, screen, pkt_type, payload)
+    if batch:
+        display["grid"].stamp(batch)
+
+
+def draw_line(points, color, size):
+    display["grid"].line(points, color, size)
+
+
+def stroke_to(conn, pos, color, size):
+    grid_pos = to_grid_pos(pos)
+    stroke = game_variables["stroke"]
+    if stroke is not None and (stroke["color"] != color or stroke["size"] != size):
+        end_stroke(conn)
+        stroke = None
+    if stroke is None:
+        stroke = game_variables["stroke"] = {"color": color, "size": size, "last": None, "points": []}
+    last = stroke["points"][-1] if stroke["points"] else stroke["last"]
+    if grid_pos != last:
+        stroke["points"].append(grid_pos)
+
+
+def flush_stroke(conn):
+    stroke = game_variables["stroke"]
+    if stroke is None or not stroke["points"]:
+        return
+    # Start where the previous segment ended so the stroke stays continuous
+    points = stroke["points"] if stroke["last"] is None else [stroke["last"]] + stroke["points"]
+    for start in range(0, max(len(points) - 1, 1), protocol.LINE_MAX_POINTS - 1):
+        segment = points[start:start + protocol.LINE_MAX_POINTS]
+        send_packet(conn, "LINE", points=segment, color=stroke["color"], tool_size=stroke["size"])
+        draw_line(segment, stroke["color"], stroke["size"])
+    stroke["last"] = points[-1]
+    stroke["points"] = []
+
+
+def end_stroke(conn):
+    flush_stroke(conn)
+    game_variables["stroke"] = None
 
 
 def init_variables():
@@ -312,7 +499,7 @@ def init_variables():
     sliders["hue"] = ColorSlider([920, 560], 15, 20, (240, 240, 240), (0, 360))
 
     display["grid"] = ColorGrid([0, 0], 64, 12, (255, 255, 255))
-    display['palette'] = pygame.Surface((200, 200))
+    display['palette'] = palette_surface(sliders["hue"].slide_val)
 
     game_variables["current_color"] = (128, 30, 30)
     game_variables["selected_color"] = (128, 30, 30)
@@ -323,27 +510,45 @@ def init_variables():
     game_variables["locked"] = False
     game_variables["timer"] = 0
     game_variables['timer_text'] = "Waiting for players"
+    game_variables["binary"] = False
+    game_variables["redraw"] = True
+    game_variables["cursor_rect"] = None
+    game_variables["stroke"] = None
 
 
 def send_packet(conn, pkt_name, **payload):
     packet = ""
     if pkt_name == "PAINT":
-        x, y = payload["pos"]
-        color_str = ",".join([str(_) for _ in payload["color"][:3]])
-        packet = f"{pkt_name},{x},{y},{color_str},{payload['tool_size']}"
-    elif pkt_name == "TIME_UP":
-        packet = f"{pkt_name},"
-    conn.sendall(f"G,{packet}@".encode())
+        x, y = to_grid_pos(payload["pos"])
+        r, g, b = payload["color"][:3]
+        packet = (x, y, r, g, b, payload["tool_size"])
+    elif pkt_name == "LINE":
+        r, g, b = payload["color"][:3]
+        packet = (r, g, b, payload["tool_size"], tuple(payload["points"]))
+    elif pkt_name == "FILL":
+        x, y = payload["grid_pos"]
+        r, g, b = payload["color"][:3]
+        packet = (x, y, r, g, b)
+    conn.sendall(protocol.encode_packet("G", pkt_name, packet, game_variables["binary"]))
 
 
 def decode_packet(conn, screen, pkt_type, payload):
     if pkt_type == "CLEAR":
         display["grid"].clean()
     elif pkt_type == "PAINT":
-        s = payload.split(",")
-        paint((int(s[0]), int(s[1])), (int(s[2]), int(s[3]), int(s[4])), int(s[5]))
+        x, y, r, g, b, size = payload
+        paint_cells((x, y), (r, g, b), size)
+    elif pkt_type == "FILL":
+        x, y, r, g, b = payload
+        fill((x, y), (r, g, b))
+    elif pkt_type == "LINE":
+        r, g, b, size, points = payload
+        draw_line(points, (r, g, b), size)
+    elif pkt_type == "SNAPSHOT":
+        display["grid"].load_snapshot(payload)
     elif pkt_type == "LOCK":
         game_variables["locked"] = True
+        game_variables["redraw"] = True
     elif pkt_type == "TURN":
         game_variables["locked"] = False
         draw_toolbar(screen)
@@ -360,12 +565,12 @@ def start_counter():
 
 def draw_tools(screen):
     tool_activate()
-    pygame.draw.rect(screen, (180, 180, 180), (800, 50, 240, 50))
+    mark_dirty(pygame.draw.rect(screen, (180, 180, 180), (800, 50, 240, 50)))
     for idx, tool in tools.items():
         button = tool.button
         button.clicked = (game_variables["current_tool"] == idx)
         button.draw(screen)
-        screen.blit(pygame.transform.scale(tool.icon, (22, 22)), (button.pos[0] + 3, button.pos[1] + 3))
+        screen.blit(tool.small_icon, (button.pos[0] + 3, button.pos[1] + 3))
 
 
 def draw_sliders(screen):
@@ -374,33 +579,116 @@ def draw_sliders(screen):
 
 
 def draw_counter(screen):
-    toolbar_font = pygame.font.SysFont("Consolas", 20)
-    pygame.draw.rect(screen, (150, 150, 150), (820, 700, SCREEN_WIDTH - 830, SCREEN_HEIGHT - 710))
     timer_text = game_variables['timer_text']
     if game_variables['timer'] > 0:
         timer_text += f": {game_variables['timer']}"
+    if timer_text == display.get("counter_text"):
+        return
+    display["counter_text"] = timer_text
 
-    screen.blit(toolbar_font.render(timer_text, True, (50, 50, 50)), (820, 700))
+    mark_dirty(pygame.draw.rect(screen, (150, 150, 150), (820, 700, SCREEN_WIDTH - 830, SCREEN_HEIGHT - 710)))
+    mark_dirty(screen.blit(render_text(timer_text, (50, 50, 50)), (820, 700)))
 
 
 def draw_toolbar(screen):
-    toolbar_font = pygame.font.SysFont("Consolas", 20)
-
     screen.fill((255, 255, 255))
+    mark_dirty(screen.get_rect())
+    invalidate()
     draw_walls(screen)
     draw_palette(screen)
 
-    screen.blit(toolbar_font.render("Tools", True, (50, 50, 50)), (780, 20))
+    screen.blit(render_text("Tools", (50, 50, 50)), (780, 20))
     draw_tools(screen)
 
-    screen.blit(toolbar_font.render("Size Settings", True, (50, 50, 50)), (780, 120))
+    screen.blit(render_text("Size Settings", (50, 50, 50)), (780, 120))
     draw_sliders(screen)
-    screen.blit(toolbar_font.render("Colors", True, (50, 50, 50)), (780, 250))
+    screen.blit(render_text("Colors", (50, 50, 50)), (780, 250))
+
+
+def invalidate():
+    # The whole screen was repainted, so everything has to be drawn again on the next frame
+    game_variables["redraw"] = True
+    game_variables["cursor_rect"] = None
+    display.pop("counter_text", None)
+    display.pop("current_color", None)
+
+
+def draw_locked_frame(screen):
+    grid = display["grid"]
+    if game_variables["redraw"]:
+        screen.fill((255, 255, 255))
+        mark_dirty(screen.get_rect())
+        invalidate()
+        game_variables["redraw"] = False
+        draw_walls(screen)
+        grid.draw(screen)
+    else:
+        grid.draw_changes(screen)
+    draw_counter(screen)
+    update_display()
+
 
+def draw_painting_frame(screen, cur_pos):
+    grid = display["grid"]
+    if game_variables["redraw"]:
+        game_variables["redraw"] = False
+        grid.draw(screen)
+    else:
+        grid.draw_changes(screen)
+        # Paint the grid back over where the cursor was drawn last frame
+        if game_variables["cursor_rect"] is not None:
+            grid.draw(screen, game_variables["cursor_rect"])
 
-def main(msg_queue, conn):
+    draw_tools(screen)
+
+    cursorX, cursorY = cur_pos
+    cur_tool = game_variables["current_tool"]
+    color = game_variables["current_color"]
+    cursor_rect = None
+
+    if is_within_grid(cursorX, cursorY):
+        if cur_tool == ToolType.BRUSH_TOOL:
+            cursor_rect = pygame.draw.circle(screen, color, cur_pos, game_variables["brush_size"] * 6)
+        elif cur_tool == ToolType.ERASER_TOOL:
+            cursor_rect = pygame.draw.circle(screen, (50, 50, 50), cur_pos, game_variables["eraser_size"] * 6)
+        elif cur_tool == ToolType.FILL_TOOL:
+            cursor_rect = screen.blit(tools[cur_tool].small_icon, (cursorX, cursorY - 35))
+        elif cur_tool == ToolType.EYEDROPPER_TOOL:
+            cursor_rect = screen.blit(tools[cur_tool].small_icon, (cursorX, cursorY - 30))
+    game_variables["cursor_rect"] = cursor_rect
+    if cursor_rect is not None:
+        mark_dirty(cursor_rect)
+
+    draw_counter(screen)
+    draw_current_color(screen)
+    update_display()
+
+
+def wake():
+    # Called by the socket thread once it queued packets, so an idle main() picks them up
+    try:
+        pygame.event.post(pygame.event.Event(NETWORK_EVENT))
+    except pygame.error:
+        pass
+
+
+def next_events(clock, max_fps, active):
+    events = []
+    if not active:
+        # Nothing changes on screen by itself, sleep until input, a packet or the counter
+        event = pygame.event.wait(IDLE_WAIT)
+        if event.type != pygame.NOEVENT:
+            events.append(event)
+    # Still capped when woken, so bursts of events are handled a frame at a time
+    clock.tick(max_fps)
+    return events + pygame.event.get()
+
+
+def main(msg_queue, conn, binary=False, max_fps=MAX_FPS):
     pygame.init()
+    clear_render_cache()
     init_variables()
+    game_variables["binary"] = binary
 
     screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     pygame.display.set_caption("SoulPainter")
@@ -414,18 +702,18 @@ def main(msg_queue, conn):
     cell_size = grid.cell_size
 
     draw_toolbar(screen)
+    # Draw the first frame without waiting for an event
+    wake()
 
     while True:
+        active = not game_variables["locked"] and (clicking or any(s.clicked for s in sliders.values()))
+        events = next_events(clock, max_fps, active)
         if conn is not None and conn.fileno() == -1:
             pygame.quit()
             return
-        while not msg_queue.empty():
-            msg = msg_queue.get()
-            data = msg.split(",", 1)
-            decode_packet(conn, screen, data[0], data[1] if len(data) > 1 else None)
-        clock.tick(MAX_FPS)
+        apply_messages(msg_queue, conn, screen)
         if game_variables["locked"]:
-            for event in pygame.event.get():
+            for event in events:
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     if conn: conn.close()
@@ -435,18 +723,14 @@ def main(msg_queue, conn):
                         pygame.time.set_timer(TIMER_EVENT, 0)
                     else:
                         game_variables["timer"] -= 1
-            screen.fill((255, 255, 255))
-            draw_walls(screen)
-            draw_counter(screen)
             pygame.mouse.set_visible(True)
-            grid.draw(screen)
-            pygame.display.update()
+            draw_locked_frame(screen)
             continue
         cur_pos = pygame.mouse.get_pos()
         cursorX, cursorY = cur_pos
         cur_tool = game_variables["current_tool"]
         color = game_variables["current_color"]
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 pygame.quit()
                 if conn: conn.close()
@@ -470,15 +754,15 @@ def main(msg_queue, conn):
                             tool_size = game_variables["brush_size"] if cur_tool == ToolType.BRUSH_TOOL else \
                                 game_variables[
                                     "eraser_size"]
-                            send_packet(conn, "PAINT", pos=cur_pos, color=color, tool_size=tool_size)
-                            paint(cur_pos, color, tool_size)
+                            stroke_to(conn, event.pos, color, tool_size)
                             clicking = True
                             continue
                         gridX = remap(0, cell_count * cell_size, 0, cell_count, cursorX)
                         gridY = remap(0, cell_count * cell_size, 0, cell_count, cursorY)
-                        cursor_color = grid[gridX][gridY].color
+                        cursor_color = grid.get_color(gridX, gridY)
                         if cur_tool == ToolType.FILL_TOOL:
-                            fill((gridX, gridY), cursor_color, color)
+                            send_packet(conn, "FILL", grid_pos=(gridX, gridY), color=color)
+                            fill((gridX, gridY), color)
                         elif cur_tool == ToolType.EYEDROPPER_TOOL:
                             game_variables["selected_color"] = cursor_color
 
@@ -517,6 +801,7 @@ def main(msg_queue, conn):
                     switch_tool()
                 elif event.button == 1:
                     clicking = False
+                    end_stroke(conn)
                     for slider in sliders.values():
                         slider.clicked = False
                         slider.subsurface.set_alpha(255)
@@ -528,12 +813,14 @@ def main(msg_queue, conn):
                 else:
                     pygame.mouse.set_visible(True)
                 if clicking:
-                    if is_within_grid(cursorX, cursorY) and (
+                    if is_within_grid(*event.pos) and (
                             cur_tool == ToolType.BRUSH_TOOL or cur_tool == ToolType.ERASER_TOOL):
                         tool_size = game_variables["brush_size"] if cur_tool == ToolType.BRUSH_TOOL else game_variables[
                             "eraser_size"]
-                        send_packet(conn, "PAINT", pos=cur_pos, color=color, tool_size=tool_size)
-                        paint(cur_pos, color, tool_size)
+                        stroke_to(conn, event.pos, color, tool_size)
+                    else:
+                        # Leaving the grid breaks the line instead of joining the exit and entry points
+                        end_stroke(conn)
                 else:
                     for tool in tools.values():
                         button = tool.button
@@ -554,28 +841,9 @@ def main(msg_queue, conn):
                             elif name == "hue":
                                 draw_palette(screen)
 
-        tool_activate()
-        grid.draw(screen)
-
-        draw_tools(screen)
-
-        cur_tool = game_variables["current_tool"]
-        color = game_variables["current_color"]
-
-        if is_within_grid(cursorX, cursorY):
-            if cur_tool == ToolType.BRUSH_TOOL:
-                pygame.draw.circle(screen, color, cur_pos, game_variables["brush_size"] * 6)
-            elif cur_tool == ToolType.ERASER_TOOL:
-                pygame.draw.circle(screen, (50, 50, 50), cur_pos, game_variables["eraser_size"] * 6)
-            elif cur_tool == ToolType.FILL_TOOL:
-                screen.blit(pygame.transform.scale(tools[cur_tool].icon, (22, 22)), (cursorX, cursorY - 35))
-            elif cur_tool == ToolType.EYEDROPPER_TOOL:
-                screen.blit(pygame.transform.scale(tools[cur_tool].icon, (22, 22)), (cursorX, cursorY - 30))
-
-        draw_counter(screen)
-        draw_current_color(screen)
-
-        pygame.display.update()
+        # Everything drawn this frame goes out as one segment
+        flush_stroke(conn)
+        draw_painting_frame(screen, cur_pos)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+import protocol
+
+GUESSES = ["貓", "狗", "房子", "太陽", "汽車", "飛機", "大樹", "雨傘"]
+CHATS = ["好難喔", "這是什麼", "加油", "畫得不錯", "哈哈哈"]
+# Seconds a sent stroke waits for its echo, later echoes are not counted in the latency
+ECHO_TIMEOUT = 30
+
+
+class Stats:
+    def __init__(self):
+        self.recording = False
+        self.paint_sent = {}
+        self.paints_sent = 0
+        self.paints_received = 0
+        self.guesses_sent = 0
+        self.chats_sent = 0
+        self.bytes_received = 0
+        self.reads = 0
+        self.latencies = []
+        self.joined = 0
+        self.disconnected = 0
+
+
+class Bot:
+    sequence = itertools.count()
+
+    def __init__(self, index, stats, args):
+        self.name = f"bot{index}"
+        self.stats = stats
+        self.args = args
+        self.binary = False
+        self.packet_reader = protocol.PacketReader()
+        self.color_table = protocol.ColorTable()
+        self.writer = None
+        self.painter = None
+        self.guesser = None
+
+    def send(self, channel, pkt_type, payload=""):
+        self.writer.write(protocol.encode_packet(channel, pkt_type, payload, self.binary))
+
+    async def run(self, host, port):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(protocol.encode_packet("G", "JOIN", f"{self.name},{self.args.protocol},{self.args.room}"))
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                now = time.perf_counter()
+                if self.stats.recording:
+                    self.stats.bytes_received += len(data)
+                    self.stats.reads += 1
+                self.packet_reader.feed(data)
+                for channel, pkt_type, payload in self.packet_reader.packets():
+                    if channel == "G":
+                        packet = self.color_table.expand(pkt_type, payload)
+                        if packet is None:
+                            continue
+                        pkt_type, payload = packet
+                    self.handle_packet(channel, pkt_type, payload, now)
+            self.stats.disconnected += 1
+        except ConnectionError:
+            self.stats.disconnected += 1
+        finally:
+            self.stop_painting()
+            if self.guesser is not None:
+                self.guesser.cancel()
+            self.writer.close()
+
+    def handle_packet(self, channel, pkt_type, payload, now):
+        if channel == "N" and pkt_type == "WELCOME":
+            self.binary = int(payload) >= protocol.BINARY_VERSION
+            self.packet_reader.binary = self.binary
+            self.stats.joined += 1
+            self.guesser = asyncio.get_running_loop().create_task(self.guess())
+        elif channel == "G" and pkt_type in ("PAINT", "LINE"):
+            sent = self.stats.paint_sent.get(payload)
+            if sent is not None and self.stats.recording:
+                self.stats.paints_received += 1
+                self.stats.latencies.append(now - sent)
+        elif channel == "G" and pkt_type == "TURN":
+            self.stop_painting()
+            self.painter = asyncio.get_running_loop().create_task(self.paint())
+        elif channel == "G" and pkt_type == "LOCK":
+            self.stop_painting()
+
+    def stop_painting(self):
+        if self.painter is not None:
+            self.painter.cancel()
+            self.painter = None
+
+    async def paint(self):
+        interval = 1 / self.args.paint_rate
+        deadline = time.perf_counter()
+        while True:
+            seq = next(Bot.sequence)
+            # Every stroke is unique, so receivers can look up when it was sent
+            if self.args.line_points > 1:
+                x, y = seq % 64, seq // 64 % 64
+                points = tuple(((x + i) % 64, (y + i // 2) % 64) for i in range(self.args.line_points))
+                op, payload = "LINE", (seq & 0xff, seq >> 8 & 0xff, seq >> 16 & 0xff, random.randint(1, 5), points)
+            else:
+                op, payload = "PAINT", (seq % 64, seq // 64 % 64, seq >> 12 & 0xff, seq >> 20 & 0xff,
+                                        seq >> 28 & 0xff, random.randint(1, 5))
+            now = time.perf_counter()
+            paint_sent = self.stats.paint_sent
+            paint_sent[payload] = now
+            # The dict keeps send order, so expired strokes are always at the front
+            while True:
+                oldest = next(iter(paint_sent))
+                if now - paint_sent[oldest] <= ECHO_TIMEOUT:
+                    break
+                del paint_sent[oldest]
+            if self.stats.recording:
+                self.stats.paints_sent += 1
+            self.send("G", op, payload)
+            deadline += interval
+            await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+
+    async def guess(self):
+        while True:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.guess_interval)
+            if self.painter is not None:
+                continue
+            if random.random() < 0.5:
+                self.send("N", "GUESS", random.choice(GUESSES))
+                if self.stats.recording:
+                    self.stats.guesses_sent += 1
+            else:
+                self.send("C", None, random.choice(CHATS))
+                if self.stats.recording:
+                    self.stats.chats_sent += 1
+
+
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+
+def cpu_time(pid):
+    # utime + stime of the server and its worker processes, in seconds
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, server_args):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    process = subprocess.Popen([sys.executable, server_path, "--host", "127.0.0.1", "--port", str(port),
+                                *shlex.split(server_args)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server.py did not start listening")
+
+
+async def run(args, host, port, server_pid):
+    stats = Stats()
+    tasks = []
+    for index in range(args.clients):
+        tasks.append(asyncio.get_running_loop().create_task(Bot(index, stats, args).run(host, port)))
+        await asyncio.sleep(1 / args.connect_rate)
+
+    await asyncio.sleep(args.warmup)
+    print(f"[LoadTest] {stats.joined}/{args.clients} clients joined, measuring for {args.duration} seconds")
+    cpu_start = cpu_time(server_pid) if server_pid else None
+    start = time.perf_counter()
+    stats.recording = True
+    await asyncio.sleep(args.duration)
+    stats.recording = False
+    elapsed = time.perf_counter() - start
+    cpu_end = cpu_time(server_pid) if server_pid else None
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies = sorted(stats.latencies)
+    result = {
+        "clients": args.clients,
+        "joined": stats.joined,
+        "disconnected": stats.disconnected,
+        "duration": round(elapsed, 3),
+        "paints_sent_per_sec": round(stats.paints_sent / elapsed, 1),
+        "paints_received_per_sec": round(stats.paints_received / elapsed, 1),
+        "guesses_per_sec": round(stats.guesses_sent / elapsed, 1),
+        "chats_per_sec": round(stats.chats_sent / elapsed, 1),
+        "received_kib_per_sec": round(stats.bytes_received / elapsed / 1024, 1),
+        # Socket reads that returned data, about one per batch of packets the server sent
+        "reads_per_sec": round(stats.reads / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "latency_max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        "server_cpu_percent": round((cpu_end - cpu_start) / elapsed * 100, 1) if server_pid else None,
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator for the SoulPainter server")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="test a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the running server, to report its CPU usage")
+    parser.add_argument("--server-args", default="",
+                        help='extra arguments for the server.py that is started, as --server-args="--asyncio"')
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--room", default="", help="join this room instead of matchmaking")
+    parser.add_argument("--protocol", type=int, default=protocol.PROTOCOL_VERSION, help="protocol version to ask for")
+    parser.add_argument("--paint-rate", type=float, default=60, help="PAINT packets per second from each painter")
+    parser.add_argument("--line-points", type=int, default=1,
+                        help="send strokes as LINE packets of this many points instead of single PAINTs")
+    parser.add_argument("--guess-interval", type=float, default=2, help="average seconds between guesses or chats")
+    parser.add_argument("--connect-rate", type=float, default=200, help="new connections per second")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds to wait after connecting before measuring")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        port = int(port)
+        server_pid = args.server_pid
+    else:
+        host, port = "127.0.0.1", free_port()
+        server = start_server(port, args.server_args)
+        server_pid = server.pid
+
+    try:
+        result = asyncio.run(run(args, host, port, server_pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    for key, value in result.items():
+        print(f"[LoadTest] {key}: {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import bisect
+import functools
+from array import array
+
+import canvas
+import protocol
+
+# Every record is kind, x, y, r, g, b, size. A LINE takes one record per point, FILL leaves size at 0.
+RECORD_SIZE = 7
+PAINT, FILL, LINE = 0, 1, 2
+KINDS = {"PAINT": PAINT, "FILL": FILL, "LINE": LINE}
+# Compact once the log holds this many ops, and again whenever it has doubled since the last time
+COMPACT_MIN = 1024
+
+
+@functools.lru_cache(maxsize=None)
+def brush_layout(size, cell_count):
+    brush = canvas.BRUSHES.get(size, canvas.BRUSHES[1])
+    reach = max(max(abs(dx), abs(dy)) for dx, dy in brush)
+    return brush, reach, tuple(dy * cell_count + dx for dx, dy in brush)
+
+
+def op_cells(op, payload, cell_count=canvas.CELL_COUNT):
+    # Indexes of the cells a PAINT or LINE writes, clipped to the canvas like Canvas.paint and Canvas.line
+    if op == "PAINT":
+        x, y, _, _, _, size = payload
+        centers = ((x, y),)
+    else:
+        _, _, _, size, points = payload
+        centers = set(canvas.line_cells(points))
+    brush, reach, offsets = brush_layout(size, cell_count)
+    cells = set()
+    for x, y in centers:
+        if reach <= x < cell_count - reach and reach <= y < cell_count - reach:
+            # The whole brush is on the canvas, no need to clip cell by cell
+            base = y * cell_count + x
+            cells.update([base + offset for offset in offsets])
+        else:
+            cells.update([(y + dy) * cell_count + x + dx for dx, dy in brush
+                          if 0 <= x + dx < cell_count and 0 <= y + dy < cell_count])
+    return cells
+
+
+class OpLog:
+    # The draw ops of a turn packed into fixed-width records. Steps keep counting every op ever appended,
+    # so a player's step stays valid after compaction drops ops that later ones painted over.
+    def __init__(self, cell_count=canvas.CELL_COUNT):
+        self.cell_count = cell_count
+        self.records = bytearray()
+        # Per kept op: its step and the index of its first record
+        self.steps = array("I")
+        self.starts = array("I")
+        self.count = 0
+        self.compact_at = COMPACT_MIN
+
+    def __len__(self):
+        return self.count
+
+    def append(self, op, payload):
+        # Raises ValueError for values that do not fit in a byte, and leaves the log unchanged
+        if op == "LINE":
+            r, g, b, size, points = payload
+            if not points:
+                raise ValueError("LINE without points")
+            # Text clients can send any number of points, binary frames count them in one byte
+            if len(points) > protocol.LINE_MAX_POINTS:
+                raise ValueError(f"LINE with {len(points)} points")
+            records = b"".join(bytes((LINE, x, y, r, g, b, size)) for x, y in points)
+        elif op == "FILL":
+            records = bytes((FILL, *payload, 0))
+        else:
+            records = bytes((KINDS[op], *payload))
+        self.steps.append(self.count)
+        self.starts.append(len(self.records) // RECORD_SIZE)
+        self.records += records
+        self.count += 1
+        if len(self.steps) >= self.compact_at:
+            self.compact()
+            self.compact_at = max(COMPACT_MIN, len(self.steps) * 2)
+
+    def read(self, index):
+        start = self.starts[index] * RECORD_SIZE
+        end = self.starts[index + 1] * RECORD_SIZE if index + 1 < len(self.starts) else len(self.records)
+        records = self.records
+        kind = records[start]
+        if kind == PAINT:
+            return "PAINT", tuple(records[start + 1:start + 7])
+        if kind == FILL:
+            return "FILL", tuple(records[start + 1:start + 6])
+        points = tuple(zip(records[start + 1:end:RECORD_SIZE], records[start + 2:end:RECORD_SIZE]))
+        return "LINE", (*records[start + 3:start + 7], points)
+
+    def next_op(self, step):
+        # The first op kept at or after step, as (its step, op, payload)
+        index = bisect.bisect_left(self.steps, step)
+        return (self.steps[index], *self.read(index))
+
+    def compact(self):
+        # Walk back from the newest op and drop every op whose cells were all written again later.
+        # A fill depends on everything drawn before it, so coverage starts over at each one.
+        covered = set()
+        keep = []
+        for index in range(len(self.steps) - 1, -1, -1):
+            op, payload = self.read(index)
+            if op == "FILL":
+                covered = set()
+                keep.append(index)
+                continue
+            cells = op_cells(op, payload, self.cell_count)
+            # The newest op always stays, so every step below the count has a kept op at or after it
+            if keep and cells <= covered:
+                continue
+            covered |= cells
+            keep.append(index)
+        if len(keep) == len(self.steps):
+            return
+
+        records, steps, starts = bytearray(), array("I"), array("I")
+        for index in reversed(keep):
+            start = self.starts[index] * RECORD_SIZE
+            end = self.starts[index + 1] * RECORD_SIZE if index + 1 < len(self.starts) else len(self.records)
+            steps.append(self.steps[index])
+            starts.append(len(records) // RECORD_SIZE)
+            records += self.records[start:end]
+        print(f"[OpLog] Compacted {len(self.steps)} ops into {len(keep)}")
+        self.records, self.steps, self.starts = records, steps, starts
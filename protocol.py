@@ -0,0 +1,291 @@
+import base64
+import struct
+
+TEXT_VERSION = 1
+BINARY_VERSION = 2
+# Binary, with draw ops that name their colour by its index in the turn's colour table
+INDEXED_VERSION = 3
+PROTOCOL_VERSION = 3
+CELL_SIZE = 12
+
+# Binary frames: opcode, payload length, then the payload
+HEADER = struct.Struct("!BH")
+# PAINT payload: cell x, cell y, r, g, b, tool size
+PAINT = struct.Struct("!6B")
+# FILL payload: seed cell x, y, r, g, b
+FILL = struct.Struct("!5B")
+# LINE payload: r, g, b, tool size, point count, then a cell x, y byte pair per point
+LINE = struct.Struct("!5B")
+LINE_MAX_POINTS = 255
+# Indexed ops: IPAINT is cell x, y, colour index, tool size, IFILL cell x, y, colour index,
+# and ILINE colour index, tool size, point count, then the points like LINE
+IPAINT = struct.Struct("!4B")
+IFILL = struct.Struct("!3B")
+ILINE = struct.Struct("!3B")
+# COLOR payload: colour index, r, g, b. COLORS is the whole table, r, g, b for each index in order
+COLOR = struct.Struct("!4B")
+MAX_COLORS = 256
+INDEXED_OPS = {"PAINT": "IPAINT", "FILL": "IFILL", "LINE": "ILINE"}
+RECV_BUFFER_SIZE = 16 * 1024
+# Compact or grow the receive buffer before a read would get less than this
+RECV_MIN_SIZE = 4096
+# The longest binary frame the header can describe, text packets are held to the same size
+MAX_FRAME_SIZE = HEADER.size + 0xFFFF
+
+OPCODES = {
+    ("G", "JOIN"): 1,
+    ("G", "PAINT"): 2,
+    ("G", "CLEAR"): 3,
+    ("G", "LOCK"): 4,
+    ("G", "TURN"): 5,
+    ("G", "TIME"): 6,
+    ("G", "TIME_UP"): 7,
+    ("G", "GRID_STATUS"): 8,
+    ("G", "GRID_QUERY"): 9,
+    ("N", "INFO"): 10,
+    ("N", "SCORE"): 11,
+    ("N", "WELCOME"): 12,
+    ("N", "DUPNAME"): 13,
+    ("N", "GUESS"): 14,
+    ("C", None): 15,
+    ("G", "SNAPSHOT"): 16,
+    ("N", "ROOMFULL"): 17,
+    ("G", "FILL"): 18,
+    ("G", "LINE"): 19,
+    ("N", "SESSION"): 20,
+    ("G", "RESUME"): 21,
+    ("N", "EXPIRED"): 22,
+    ("N", "ROSTER"): 23,
+    ("G", "COLOR"): 24,
+    ("G", "COLORS"): 25,
+    ("G", "IPAINT"): 26,
+    ("G", "IFILL"): 27,
+    ("G", "ILINE"): 28,
+    ("N", "BADNAME"): 29,
+}
+PACKET_TYPES = {opcode: key for key, opcode in OPCODES.items()}
+
+
+def encode_text(channel, pkt_type, payload=""):
+    if pkt_type == "PAINT":
+        x, y, r, g, b, size = payload
+        payload = f"{x * CELL_SIZE},{y * CELL_SIZE},{r},{g},{b},{size}"
+    elif pkt_type == "FILL":
+        x, y, r, g, b = payload
+        payload = f"{x * CELL_SIZE},{y * CELL_SIZE},{r},{g},{b}"
+    elif pkt_type == "LINE":
+        r, g, b, size, points = payload
+        payload = ",".join([f"{r},{g},{b},{size}"] + [f"{x * CELL_SIZE},{y * CELL_SIZE}" for x, y in points])
+    elif pkt_type == "SNAPSHOT":
+        payload = str(base64.b64encode(payload), encoding='ascii')
+    if pkt_type is None:
+        return f"{channel},{payload}@".encode()
+    return f"{channel},{pkt_type},{payload}@".encode()
+
+
+def encode_binary(channel, pkt_type, payload=""):
+    if pkt_type == "PAINT":
+        body = PAINT.pack(*payload)
+    elif pkt_type == "FILL":
+        body = FILL.pack(*payload)
+    elif pkt_type == "LINE":
+        r, g, b, size, points = payload
+        body = LINE.pack(r, g, b, size, len(points)) + bytes(c for point in points for c in point)
+    elif pkt_type == "IPAINT":
+        body = IPAINT.pack(*payload)
+    elif pkt_type == "IFILL":
+        body = IFILL.pack(*payload)
+    elif pkt_type == "ILINE":
+        index, size, points = payload
+        body = ILINE.pack(index, size, len(points)) + bytes(c for point in points for c in point)
+    elif pkt_type == "COLOR":
+        body = COLOR.pack(*payload)
+    elif pkt_type in ("SNAPSHOT", "COLORS"):
+        body = payload
+    else:
+        body = payload.encode()
+    if len(body) > 0xFFFF:
+        raise ValueError(f"{channel},{pkt_type} payload of {len(body)} bytes does not fit in a binary frame")
+    return HEADER.pack(OPCODES[(channel, pkt_type)], len(body)) + body
+
+
+def encode_packet(channel, pkt_type, payload="", binary=False):
+    if binary:
+        return encode_binary(channel, pkt_type, payload)
+    return encode_text(channel, pkt_type, payload)
+
+
+def decode_text(packet):
+    channel, channel_pkt = packet.split(",", 1) if "," in packet else (packet, "")
+    if channel == "C":
+        return channel, None, channel_pkt
+    pkt_type, payload = channel_pkt.split(",", 1) if "," in channel_pkt else (channel_pkt, "")
+    if pkt_type == "PAINT":
+        s = payload.split(",")
+        payload = (int(s[0]) // CELL_SIZE, int(s[1]) // CELL_SIZE, int(s[2]), int(s[3]), int(s[4]), int(s[5]))
+    elif pkt_type == "FILL":
+        s = payload.split(",")
+        payload = (int(s[0]) // CELL_SIZE, int(s[1]) // CELL_SIZE, int(s[2]), int(s[3]), int(s[4]))
+    elif pkt_type == "LINE":
+        s = [int(v) for v in payload.split(",")]
+        points = tuple((x // CELL_SIZE, y // CELL_SIZE) for x, y in zip(s[4::2], s[5::2]))
+        payload = (s[0], s[1], s[2], s[3], points)
+    elif pkt_type == "SNAPSHOT":
+        payload = base64.b64decode(payload)
+    return channel, pkt_type, payload
+
+
+def decode_binary(opcode, body):
+    channel, pkt_type = PACKET_TYPES[opcode]
+    if pkt_type == "PAINT":
+        return channel, pkt_type, PAINT.unpack(body)
+    elif pkt_type == "FILL":
+        return channel, pkt_type, FILL.unpack(body)
+    elif pkt_type == "LINE":
+        r, g, b, size, count = LINE.unpack_from(body)
+        coords = body[LINE.size:LINE.size + count * 2]
+        return channel, pkt_type, (r, g, b, size, tuple(zip(coords[0::2], coords[1::2])))
+    elif pkt_type == "IPAINT":
+        return channel, pkt_type, IPAINT.unpack(body)
+    elif pkt_type == "IFILL":
+        return channel, pkt_type, IFILL.unpack(body)
+    elif pkt_type == "ILINE":
+        index, size, count = ILINE.unpack_from(body)
+        coords = body[ILINE.size:ILINE.size + count * 2]
+        return channel, pkt_type, (index, size, tuple(zip(coords[0::2], coords[1::2])))
+    elif pkt_type == "COLOR":
+        return channel, pkt_type, COLOR.unpack(body)
+    elif pkt_type in ("SNAPSHOT", "COLORS"):
+        # body may be a view of a receive buffer that is about to be reused
+        return channel, pkt_type, bytes(body)
+    return channel, pkt_type, str(body, encoding='utf-8')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def op_color(pkt_type, payload):
+    if pkt_type == "LINE":
+        return payload[:3]
+    return payload[2:5]
+
+
+def index_op(pkt_type, payload, index):
+    # The indexed form of a draw op, for a colour table that has its colour at index
+    if pkt_type == "PAINT":
+        x, y, _, _, _, size = payload
+        return "IPAINT", (x, y, index, size)
+    elif pkt_type == "FILL":
+        x, y, _, _, _ = payload
+        return "IFILL", (x, y, index)
+    _, _, _, size, points = payload
+    return "ILINE", (index, size, points)
+
+
+class ColorTable:
+    # The receiving end of a turn's colour table, turns indexed ops back into the plain ones
+    def __init__(self):
+        self.colors = {}
+
+    def expand(self, pkt_type, payload):
+        # Returns the op to handle in place of a G packet, or None when the packet only changed the table
+        if pkt_type == "IPAINT":
+            x, y, index, size = payload
+            return "PAINT", (x, y, *self.colors[index], size)
+        elif pkt_type == "ILINE":
+            index, size, points = payload
+            return "LINE", (*self.colors[index], size, points)
+        elif pkt_type == "IFILL":
+            x, y, index = payload
+            return "FILL", (x, y, *self.colors[index])
+        elif pkt_type == "COLOR":
+            index, r, g, b = payload
+            self.colors[index] = (r, g, b)
+            return None
+        elif pkt_type == "COLORS":
+            self.colors = {i // 3: tuple(payload[i:i + 3]) for i in range(0, len(payload), 3)}
+            return None
+        elif pkt_type == "CLEAR":
+            self.colors = {}
+        return pkt_type, payload
+
+
+class PacketReader:
+    # One reusable receive buffer per connection: recv_into writes at end, frames are parsed
+    # from start, and a partial frame at the tail waits there for the rest of its bytes.
+    def __init__(self, binary=False, size=RECV_BUFFER_SIZE):
+        self.binary = binary
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def writable(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size:
+                # Give back what a big frame made the buffer grow to
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+        if len(self.buffer) - self.end < RECV_MIN_SIZE:
+            pending = self.end - self.start
+            if len(self.buffer) - pending < RECV_MIN_SIZE:
+                # A frame bigger than the buffer, typically a snapshot
+                buffer = bytearray(len(self.buffer) * 2)
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer, self.view = buffer, memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def commit(self, size):
+        self.end += size
+        return self.view[self.end - size:self.end]
+
+    def feed(self, data):
+        while data:
+            free = self.writable()
+            size = min(len(free), len(data))
+            free[:size] = data[:size]
+            self.commit(size)
+            data = data[size:]
+
+    def packets(self):
+        # The protocol may switch to binary between two packets, so parse lazily
+        while True:
+            try:
+                packet = self.next_binary() if self.binary else self.next_text()
+            except ProtocolError:
+                raise
+            except (ValueError, IndexError, KeyError, struct.error) as e:
+                # The bad packet is already consumed, but a peer that sends one cannot be trusted with the rest
+                raise ProtocolError(f"Malformed packet: {e!r}")
+            if packet is None:
+                return
+            if packet:
+                yield packet
+
+    def next_text(self):
+        end = self.buffer.find(b"@", self.start, self.end)
+        # Without a limit, a peer that never sends @ would make the buffer grow for as long as it keeps sending
+        if (self.end if end == -1 else end) - self.start > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Text packet longer than {MAX_FRAME_SIZE} bytes")
+        if end == -1:
+            return None
+        packet = str(self.view[self.start:end], encoding='utf-8')
+        self.start = end + 1
+        return decode_text(packet) if packet else ()
+
+    def next_binary(self):
+        if self.end - self.start < HEADER.size:
+            return None
+        opcode, length = HEADER.unpack_from(self.buffer, self.start)
+        end = self.start + HEADER.size + length
+        if self.end < end:
+            return None
+        body = self.view[self.start + HEADER.size:end]
+        self.start = end
+        return decode_binary(opcode, body)
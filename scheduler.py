@@ -0,0 +1,124 @@
+import math
+import time
+
+RESOLUTION = 0.05
+SLOTS = 64
+LEVELS = 4
+
+
+class Timer:
+    __slots__ = ("deadline", "tick", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, tick, callback, args):
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def remaining(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self.deadline - now)
+
+
+class TimerWheel:
+    # Hierarchical timing wheel: level 0 holds the next SLOTS ticks, every higher level
+    # covers SLOTS times the range of the one below and is cascaded down as time passes.
+    def __init__(self, resolution=RESOLUTION, slots=SLOTS, levels=LEVELS, clock=time.monotonic):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        self.current_tick = int(clock() / resolution)
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []
+        self.count = 0
+        self.level0_count = 0
+        self.on_schedule = None
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, math.ceil(deadline / self.resolution), callback, args)
+        # The current tick has already fired, so the earliest slot is the next one
+        self.insert(timer, self.current_tick + 1)
+        self.count += 1
+        if self.on_schedule is not None:
+            self.on_schedule()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def insert(self, timer, earliest):
+        tick = max(timer.tick, earliest)
+        delta = tick - self.current_tick
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots:
+                self.wheels[level][(tick // span) % self.slots].append(timer)
+                if level == 0:
+                    self.level0_count += 1
+                return
+            span *= self.slots
+        self.overflow.append(timer)
+
+    def cascade(self, level):
+        span = self.slots ** level
+        bucket = self.wheels[level][(self.current_tick // span) % self.slots]
+        self.wheels[level][(self.current_tick // span) % self.slots] = []
+        for timer in bucket:
+            if not timer.cancelled:
+                self.insert(timer, self.current_tick)
+            else:
+                self.count -= 1
+
+    def advance(self, now=None):
+        if now is None:
+            now = self.clock()
+        # Tolerate float rounding when woken exactly at a tick boundary
+        target = int(now / self.resolution + 1e-6)
+        if self.count == 0:
+            self.current_tick = max(self.current_tick, target)
+            return
+        while self.current_tick < target:
+            if self.level0_count == 0:
+                # Nothing can fire before the next cascade, skip straight to it
+                boundary = (self.current_tick // self.slots + 1) * self.slots
+                self.current_tick = min(target, boundary) - 1
+            self.current_tick += 1
+            top = self.slots ** (self.levels - 1)
+            if self.current_tick % (top * self.slots) == 0 and self.overflow:
+                timers, self.overflow = self.overflow, []
+                for timer in timers:
+                    self.insert(timer, self.current_tick)
+            for level in range(self.levels - 1, 0, -1):
+                if self.current_tick % (self.slots ** level) == 0:
+                    self.cascade(level)
+            slot = self.current_tick % self.slots
+            bucket = self.wheels[0][slot]
+            if not bucket:
+                continue
+            self.wheels[0][slot] = []
+            self.level0_count -= len(bucket)
+            for timer in bucket:
+                self.count -= 1
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+    def next_timeout(self, now=None):
+        if self.count == 0:
+            return None
+        if now is None:
+            now = self.clock()
+        # Sleep until the next tick that has timers to fire or a higher level to cascade
+        if self.level0_count == 0:
+            boundary = (self.current_tick // self.slots + 1) * self.slots
+            return max(0.0, boundary * self.resolution - now)
+        for i in range(1, self.slots + 1):
+            tick = self.current_tick + i
+            if self.wheels[0][tick % self.slots] or tick % self.slots == 0:
+                return max(0.0, tick * self.resolution - now)
+        return max(0.0, (self.current_tick + self.slots) * self.resolution - now)
@@ -1,16 +1,54 @@
+import argparse
+import asyncio
+import math
+import multiprocessing
 import socket
 import selectors
-import threading
-import time
 import random
-from queue import Queue
+import re
+import secrets
+import zlib
+from collections import deque
+
+import canvas
+import oplog
+import protocol
+import scheduler
 
 HOST = '0.0.0.0'
 PORT = 48763
+SEND_BUFFER_LIMIT = 256 * 1024
+# Most the acceptor reads before handing a connection off, workers receive the same size over SEQPACKET
+HANDOFF_SIZE = 4096
+ROOM_SIZE = 8
+TURN_TIME = 60
+BREAK_TIME = 5
+IDLE_TIMEOUT = 600
+RESUME_GRACE = 30
+# Same rule as the client, names end up in the comma and semicolon separated ROSTER and SCORE rows
+NAME_REGEX = r"[a-zA-Z0-9_]{1,32}"
+# Longer chat messages and guesses are cut, every player in the room gets a copy
+MAX_MESSAGE_LENGTH = 200
+# Ticks per second that batch outbound draw ops, 0 sends each op as it arrives
+TICK_RATE = 0
+OVERFLOW_POLICIES = ("snapshot", "disconnect")
+# Canvas operations, kept in the room history and coalesced into a snapshot for slow clients
+DRAW_OPS = ("PAINT", "FILL", "LINE")
+PAINT_FRAMES = DRAW_OPS + tuple(protocol.INDEXED_OPS.values())
+# Queued frames an overflow may drop, the snapshot that replaces them also replaces older snapshots
+COALESCED_FRAMES = PAINT_FRAMES + ("SNAPSHOT",)
 
 questions = ["蘋果", "柳橙", "芒果", "西瓜", "奇異果", "芭樂", "香蕉", "番茄", "檸檬", "哈密瓜", "水蜜桃", "李子", "楊桃"]
 running = True
+# Printing every read copies and formats it, so it is only done with --log-packets
+log_packets = False
 selector = selectors.DefaultSelector()
+# Since the last stats report: draw ops sent to players, the paint frames that carried them, and socket sends
+metrics = {
+    "draw_ops": 0,
+    "paint_frames": 0,
+    "sends": 0
+}
 
 
 class Player:
@@ -18,8 +56,18 @@ class Player:
         self.conn = conn
         self.addr = conn.getpeername()
         self.name = name
-        self.update_lock = threading.Lock()
         self.step = 0
+        # CLEARs and snapshots sent so far, and the history step the last one left the client at
+        self.resets = 0
+        self.base = 0
+        # Whether every op since then was sent, none of them skipped by history compaction
+        self.contiguous = True
+        self.last_active = 0
+        self.idle_timer = None
+        self.token = None
+        self.resume_timer = None
+        # Encoded draw ops waiting for the next tick
+        self.batch = []
 
     def __eq__(self, other):
         if isinstance(other, Player):
@@ -29,36 +77,41 @@ class Player:
     def is_disconnected(self):
         return self.conn.fileno() == -1
 
-    def paint(self, payload):
-        send_packet(self.conn, "G", f"PAINT,{payload}")
+    def draw(self, op, payload):
+        metrics["draw_ops"] += 1
+        send_packet(self.conn, "G", op, payload)
+
+    def reset_palette(self, step):
+        self.step = self.base = step
+        self.resets += 1
+        self.contiguous = True
+        # Whatever is still batched is older than the reset
+        self.batch = []
+
+    def send_snapshot(self, snapshot, step):
+        self.reset_palette(step)
+        send_packet(self.conn, "G", "SNAPSHOT", snapshot)
 
     def update_palette(self, history):
-        while not self.update_lock.acquire():
-            pass
         while self.step < len(history):
-            time.sleep(0.01)
-            self.paint(history[self.step])
-            self.step += 1
-        self.update_lock.release()
-
-    def clear_palette(self):
-        while not self.update_lock.acquire():
-            pass
-        self.step = 0
-        self.update_lock.release()
-        send_packet(self.conn, "G", "CLEAR")
+            # Step first, an overflowing send may move it to the end of the history
+            step, op, payload = history.next_op(self.step)
+            if step > self.step:
+                self.contiguous = False
+            self.step = step + 1
+            self.draw(op, payload)
 
     def get_turn(self):
         send_packet(self.conn, "G", "TURN")
 
     def set_timer(self, text, seconds):
-        send_packet(self.conn, "G", f"TIME,{text},{seconds}")
+        send_packet(self.conn, "G", "TIME", f"{text},{seconds}")
 
     def lock_palette(self):
         send_packet(self.conn, "G", "LOCK")
 
     def send_grid_status(self, status):
-        send_packet(self.conn, "G", f"GRID_STATUS,{status}")
+        send_packet(self.conn, "G", "GRID_STATUS", status)
 
     def send_grid_query(self):
         send_packet(self.conn, "G", "GRID_QUERY")
@@ -67,74 +120,215 @@ class Player:
         self.name = new_name
 
     def send_game_message(self, pkt_type, msg):
-        send_packet(self.conn, "N", pkt_type + "," + msg)
-
-    def send_player_message(self, msg):
-        send_packet(self.conn, "C", msg)
+        send_packet(self.conn, "N", pkt_type, msg)
 
 
 class GameServer:
-    def __init__(self):
+    def __init__(self, timers, name="lobby", capacity=ROOM_SIZE, public=True, overflow_policy="snapshot",
+                 tick_rate=TICK_RATE):
+        self.timers = timers
+        self.tick_rate = tick_rate
+        self.flush_timer = None
+        self.name = name
+        self.capacity = capacity
+        self.public = public
+        self.overflow_policy = overflow_policy
         self.connected_players = {}
-        self.paint_queue = Queue()
-        self.counter = GameCounter(self)
-        self.counter.start()
+        self.paint_queue = deque()
+        self.timer = None
+        self.timer_task = None
         self.painting_player = None
         self.painting_answer = ""
         self.guessed = set()
         self.scoreboard = {}
-        self.operation_history = []
+        self.operation_history = oplog.OpLog()
+        self.canvas = canvas.Canvas()
+        # The turn's colour table, colour to index, in index order, and the colours used once so far
+        self.colors = {}
+        self.used_colors = set()
         self.game_running = False
 
-    def player_join(self, conn, name):
-        addr = conn.getpeername()
+    def is_full(self):
+        return len(self.connected_players) >= self.capacity
 
-        duplicate_name = False
+    def has_player(self, name):
         for player in self.connected_players.values():
             if name == player.name:
-                duplicate_name = True
-                break
-        if duplicate_name:
-            send_packet(conn, "N", "DUPNAME,")
-            return
+                return True
+        return False
+
+    def player_join(self, conn, name, version):
+        addr = conn.getpeername()
+
+        if self.has_player(name):
+            send_packet(conn, "N", "DUPNAME")
+            return False
         else:
-            send_packet(conn, "N", "WELCOME,")
+            send_packet(conn, "N", "WELCOME", str(version))
+            conn.set_version(version)
 
         new_player = Player(conn, name)
+        conn.on_overflow = lambda: self.handle_overflow(new_player)
         self.connected_players[addr] = new_player
         self.scoreboard[addr] = 0
-        self.paint_queue.put(new_player)
+        self.paint_queue.append(new_player)
 
-        print(f"[GameServer] {new_player.name} ({addr}) has joined the game")
+        print(f"[GameServer] {new_player.name} ({addr}) has joined room {self.name}")
 
-        for player in self.connected_players.values():
-            player.send_game_message("INFO", f"[系統] {new_player.name} 加入了遊戲")
-            player.send_game_message("SCORE", f"{new_player.name},{self.scoreboard[addr]}")
-            new_player.send_game_message("SCORE", f"{player.name},{self.scoreboard[addr]}")
+        new_player.send_game_message("INFO", f"[系統] 你進入了房間「{self.name}」")
+
+        self.broadcast("N", "INFO", f"[系統] {new_player.name} 加入了遊戲")
+        # Everyone else only needs the new row, the joiner gets the whole table at once
+        self.broadcast("N", "SCORE", f"{new_player.name},{self.scoreboard[addr]}", exclude=new_player)
+        new_player.send_game_message("ROSTER", self.roster())
 
         new_player.lock_palette()
 
         if not self.game_running:
             self.check_next_turn()
+        elif self.painting_player is not None:
+            new_player.set_timer(f"Turn of {self.painting_player.name}", self.remaining_time())
+        else:
+            new_player.set_timer("Take a break", self.remaining_time())
+
+        # The snapshot already holds every op so far, so only later ops need to be replayed
+        new_player.send_snapshot(self.canvas.snapshot(conn.indexed), len(self.operation_history))
+        self.send_colors(new_player)
+        self.restart_stalled_turns()
+        return True
+
+    def player_resume(self, player, conn, version, resets, step):
+        old_addr, addr = player.addr, conn.getpeername()
+        send_packet(conn, "N", "WELCOME", str(version))
+        conn.set_version(version)
+        conn.on_overflow = lambda: self.handle_overflow(player)
+
+        player.conn, player.addr = conn, addr
+        self.connected_players[addr] = self.connected_players.pop(old_addr)
+        self.scoreboard[addr] = self.scoreboard.pop(old_addr)
+        if old_addr in self.guessed:
+            self.guessed.discard(old_addr)
+            self.guessed.add(addr)
+
+        print(f"[GameServer] {player.name} ({addr}) has resumed in room {self.name}")
+
+        player.send_game_message("ROSTER", self.roster())
+
+        if player is self.painting_player:
+            player.get_turn()
         else:
-            new_player.set_timer(f"Turn of {self.painting_player.name}", self.counter.counter)
+            player.lock_palette()
+        if self.painting_player is not None:
+            player.set_timer(f"Turn of {self.painting_player.name}", self.remaining_time())
+        elif self.game_running:
+            player.set_timer("Take a break", self.remaining_time())
 
-        upd = threading.Thread(target=new_player.update_palette, args=[self.operation_history])
-        upd.start()
+        # The painter's own strokes are never echoed back, so only a snapshot tells which of them arrived.
+        # Once compaction skipped ops for this player, its count of received ops no longer maps to a step.
+        acked = player.base + step
+        if player is not self.painting_player and resets == player.resets and player.contiguous and \
+                acked <= len(self.operation_history):
+            player.step = acked
+            player.batch = []
+            self.catch_up(player)
+        else:
+            player.send_snapshot(self.canvas.snapshot(conn.indexed), len(self.operation_history))
+        # Colours added while the player was away went to the old connection
+        self.send_colors(player)
+        self.restart_stalled_turns()
+
+    def restart_stalled_turns(self):
+        # A break that ran out while every queued player was away left no painter and no timer to pick one
+        if self.game_running and self.painting_player is None and self.timer is None:
+            self.check_next_turn()
+
+    def roster(self):
+        return ";".join(f"{player.name},{self.scoreboard[player.addr]}" for player in self.connected_players.values())
+
+    def broadcast(self, channel, pkt_type, payload="", exclude=None):
+        frames = {}
+        for player in self.connected_players.values():
+            if player is exclude: continue
+            send_frame(player.conn, frames, channel, pkt_type, payload)
+
+    def clear_palettes(self):
+        for player in self.connected_players.values():
+            player.reset_palette(0)
+        # Clients drop their colour table on CLEAR too
+        self.colors = {}
+        self.used_colors = set()
+        self.broadcast("G", "CLEAR")
+
+    def color_index(self, color):
+        # Index of color in the turn's colour table. A colour only gets one the second time it is used,
+        # so colours used once cost no COLOR packet. None until then, and for new colours once the table is full.
+        index = self.colors.get(color)
+        if index is None and len(self.colors) < protocol.MAX_COLORS:
+            if color not in self.used_colors:
+                self.used_colors.add(color)
+                return None
+            index = self.colors[color] = len(self.colors)
+            frames = {}
+            for player in self.connected_players.values():
+                if player.conn.indexed:
+                    send_frame(player.conn, frames, "G", "COLOR", (index, *color))
+        return index
+
+    def send_colors(self, player):
+        if player.conn.indexed and self.colors:
+            send_packet(player.conn, "G", "COLORS", b"".join(bytes(color) for color in self.colors))
+
+    def catch_up(self, player):
+        self.send_batch(player)
+        player.update_palette(self.operation_history)
+
+    def forward(self, player, data):
+        metrics["draw_ops"] += 1
+        if self.tick_rate <= 0:
+            metrics["paint_frames"] += 1
+            player.conn.send(data, True)
+            return
+        player.batch.append(data)
+        if self.flush_timer is None:
+            # The wheel ticks at the tick rate, so this runs on the next tick
+            self.flush_timer = self.timers.call_later(0, self.flush_batches)
+
+    def send_batch(self, player):
+        if player.batch:
+            metrics["paint_frames"] += 1
+            player.conn.send(b"".join(player.batch), True)
+            player.batch = []
+
+    def flush_batches(self):
+        self.flush_timer = None
+        for player in list(self.connected_players.values()):
+            self.send_batch(player)
+
+    def handle_overflow(self, player):
+        conn = player.conn
+        if self.overflow_policy == "snapshot":
+            conn.drop_paint_backlog()
+            snapshot = self.canvas.snapshot(conn.indexed)
+            if conn.backlog() + len(snapshot) <= conn.send_limit:
+                print(f"[GameServer] Coalesced the paint backlog of {player.name} ({player.addr}) into a snapshot")
+                player.send_snapshot(snapshot, len(self.operation_history))
+                return
+        print(f"[GameServer] Disconnecting {player.name} ({player.addr}), send buffer overflow")
+        conn.abort()
 
     def player_disconnect(self, addr):
         player_name = self.connected_players[addr].name
-        print(f"[GameServer] {player_name} ({addr}) has left the game")
+        print(f"[GameServer] {player_name} ({addr}) has left room {self.name}")
 
-        self.connected_players.pop(addr)
+        player = self.connected_players.pop(addr)
         self.scoreboard.pop(addr)
+        if player in self.paint_queue:
+            self.paint_queue.remove(player)
 
         is_painter = self.painting_player is not None and addr == self.painting_player.addr
 
-        for player in self.connected_players.values():
-            player.send_game_message("INFO", f"[系統] {player_name} 離開了遊戲")
-            if is_painter:
-                player.send_game_message("SCORE", f"{player_name},-1")
+        self.broadcast("N", "INFO", f"[系統] {player_name} 離開了遊戲")
+        self.broadcast("N", "SCORE", f"{player_name},-1")
 
         if is_painter:
             self.skip_painter()
@@ -142,200 +336,876 @@ class GameServer:
     def decode_packet(self, sender_conn, channel, pkt_type, payload):
         addr = sender_conn.getpeername()
         if channel == "G":
-            if pkt_type == "JOIN":
-                self.player_join(sender_conn, payload)
-            elif pkt_type == "PAINT":
+            if pkt_type in DRAW_OPS:
                 sender = self.connected_players[addr]
-                self.operation_history.append(payload)
+                try:
+                    self.operation_history.append(pkt_type, payload)
+                except ValueError:
+                    # Values that do not fit in a byte could not be sent to binary clients either
+                    return
+                self.canvas.apply(pkt_type, payload)
+                index = self.color_index(tuple(protocol.op_color(pkt_type, payload)))
+                indexed_op = protocol.index_op(pkt_type, payload, index) if index is not None else None
+                frames, indexed_frames = {}, {}
                 for player in self.connected_players.values():
-                    if player == sender: continue
-                    if player.update_lock.locked(): continue
+                    if player is sender: continue
                     if player.step == len(self.operation_history) - 1:
-                        player.paint(self.operation_history[-1])
                         player.step += 1
+                        if indexed_op is not None and player.conn.indexed:
+                            self.forward(player, encode_frame(player.conn, indexed_frames, "G", *indexed_op))
+                        else:
+                            self.forward(player, encode_frame(player.conn, frames, "G", pkt_type, payload))
                     else:
-                        print(f"[GameServer] Started update thread for {player.name} ({player.addr})")
-                        upd = threading.Thread(target=player.update_palette, args=[self.operation_history])
-                        upd.start()
+                        self.catch_up(player)
         elif channel == "N":
             sender = self.connected_players[addr]
+            payload = payload[:MAX_MESSAGE_LENGTH]
             if pkt_type == "GUESS":
                 if self.painting_player is None or sender == self.painting_player or addr in self.guessed: return
                 if payload == self.painting_answer:
                     self.guessed.add(addr)
                     self.scoreboard[addr] += 1
-                    for player in self.connected_players.values():
-                        player.send_game_message("INFO", f"[系統] {sender.name} 猜到了答案！")
-                        player.send_game_message("SCORE", f"{sender.name},{self.scoreboard[addr]}")
+                    self.broadcast("N", "INFO", f"[系統] {sender.name} 猜到了答案！")
+                    self.broadcast("N", "SCORE", f"{sender.name},{self.scoreboard[addr]}")
 
                     if len(self.guessed) == len(self.connected_players) - 1:
-                        for player in self.connected_players.values():
-                            player.send_game_message("INFO", f"[系統] 大家都猜到了答案！真是傑作！")
+                        self.broadcast("N", "INFO", f"[系統] 大家都猜到了答案！真是傑作！")
                         self.painting_player.lock_palette()
-                        self.paint_queue.put(self.painting_player)
+                        self.paint_queue.append(self.painting_player)
                         self.skip_painter()
                 else:
-                    for player in self.connected_players.values():
-                        player.send_game_message("INFO", f"{sender.name}: {payload}")
+                    self.broadcast("N", "INFO", f"{sender.name}: {payload}")
 
         elif channel == "C":
             sender = self.connected_players[addr]
-            for player in self.connected_players.values():
-                player.send_player_message(f"{sender.name}: {payload}")
+            self.broadcast("C", None, f"{sender.name}: {payload[:MAX_MESSAGE_LENGTH]}")
 
     def skip_painter(self):
-        self.operation_history = []
+        self.operation_history = oplog.OpLog()
+        self.canvas.clear()
         self.painting_player = None
-        for player in self.connected_players.values():
-            player.clear_palette()
-            player.set_timer("Take a break", 5)
-        self.counter.count("break")
+        self.clear_palettes()
+        self.broadcast("G", "TIME", f"Take a break,{BREAK_TIME}")
+        self.start_timer("break", BREAK_TIME)
 
     def turn_expired(self):
+        self.operation_history = oplog.OpLog()
+        self.canvas.clear()
         self.painting_player.lock_palette()
-        self.paint_queue.put(self.painting_player)
+        self.paint_queue.append(self.painting_player)
         self.painting_player = None
-        for player in self.connected_players.values():
-            if self.painting_answer != "":
-                player.send_game_message("INFO", f"[系統] 正確答案是：「{self.painting_answer}」")
-            player.clear_palette()
-            player.set_timer("Take a break", 5)
-        self.counter.count("break")
+        if self.painting_answer != "":
+            self.broadcast("N", "INFO", f"[系統] 正確答案是：「{self.painting_answer}」")
+        self.clear_palettes()
+        self.broadcast("G", "TIME", f"Take a break,{BREAK_TIME}")
+        self.start_timer("break", BREAK_TIME)
 
     def check_next_turn(self):
         if self.painting_player is not None: return
         if len(self.connected_players) > 1:
-            while not self.paint_queue.empty():
-                cur_player = self.paint_queue.get()
+            # Players waiting to resume keep their place in the queue
+            for cur_player in self.paint_queue:
                 if cur_player.is_disconnected(): continue
+                self.paint_queue.remove(cur_player)
                 self.next_turn(cur_player)
                 break
         else:
-            for player in self.connected_players.values():
-                player.send_game_message("INFO", "[系統] 人數不足，等待其他玩家進入")
-                player.set_timer("Waiting for players", 0)
+            self.broadcast("N", "INFO", "[系統] 人數不足，等待其他玩家進入")
+            self.broadcast("G", "TIME", "Waiting for players,0")
             self.game_running = False
 
     def next_turn(self, cur_player):
-        self.operation_history = []
+        self.operation_history = oplog.OpLog()
+        self.canvas.clear()
         self.guessed = set()
-        for player in self.connected_players.values():
-            if not self.game_running:
-                player.send_game_message("INFO", f"[系統] 遊戲開始！")
-            player.send_game_message("INFO", f"[系統] {cur_player.name} 的回合")
-            player.clear_palette()
-            player.set_timer(f"Turn of {cur_player.name}", 60)
+        if not self.game_running:
+            self.broadcast("N", "INFO", f"[系統] 遊戲開始！")
+        self.broadcast("N", "INFO", f"[系統] {cur_player.name} 的回合")
+        self.clear_palettes()
+        self.broadcast("G", "TIME", f"Turn of {cur_player.name},{TURN_TIME}")
         self.game_running = True
         self.painting_answer = random.sample(questions, 1)[0]
         self.painting_player = cur_player
         cur_player.get_turn()
         cur_player.send_game_message("INFO", f"[系統] 請畫出「{self.painting_answer}」")
-        self.counter.count("turn")
-
-
-class GameCounter(threading.Thread):
-    def __init__(self, server):
-        super().__init__()
-        self.server = server
-        self.lock = threading.Lock()
-        self.counter = -1
-        self.task = "turn"
-        self.stop = False
-
-    def run(self):
-        while not self.stop:
-            time.sleep(1)
-            while not self.lock.acquire():
-                pass
-            if self.counter >= 0:
-                self.counter -= 1
-            self.lock.release()
-            if self.counter == 0:
-                if self.task == "turn":
-                    self.server.turn_expired()
-                elif self.task == "break":
-                    self.server.check_next_turn()
-
-    def count(self, task):
-        self.task = task
-        while not self.lock.acquire():
+        self.start_timer("turn", TURN_TIME)
+
+    def start_timer(self, task, seconds):
+        self.stop_timer()
+        self.timer_task = task
+        self.timer = self.timers.call_later(seconds, self.timer_expired, task)
+
+    def stop_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def remaining_time(self):
+        if self.timer is None:
+            return 0
+        return math.ceil(self.timer.remaining(self.timers.clock()))
+
+    def timer_expired(self, task):
+        self.timer = None
+        if task == "turn":
+            self.turn_expired()
+        elif task == "break":
+            self.check_next_turn()
+
+
+class RoomManager:
+    def __init__(self, room_size=ROOM_SIZE, overflow_policy="snapshot", send_limit=SEND_BUFFER_LIMIT, room_prefix="room",
+                 idle_timeout=IDLE_TIMEOUT, resume_grace=RESUME_GRACE, shard=None, tick_rate=TICK_RATE,
+                 stats_interval=0):
+        self.room_size = room_size
+        self.overflow_policy = overflow_policy
+        self.send_limit = send_limit
+        self.room_prefix = room_prefix
+        self.idle_timeout = idle_timeout
+        self.resume_grace = resume_grace
+        self.shard = shard
+        self.tick_rate = tick_rate
+        self.stats_interval = stats_interval
+        # One wheel drives the turn, break and idle timers and the draw op ticks of every room
+        self.timers = scheduler.TimerWheel(min(scheduler.RESOLUTION, 1 / tick_rate) if tick_rate > 0
+                                           else scheduler.RESOLUTION)
+        self.rooms = {}
+        self.player_rooms = {}
+        self.matchmaking = deque()
+        self.sessions = {}
+        self.next_room_id = 1
+        self.on_change = None
+        self.stats_since = self.timers.clock()
+        if stats_interval > 0:
+            self.timers.call_later(stats_interval, self.report_stats)
+
+    def create_room(self, name=None, public=True):
+        if name is None:
+            while f"{self.room_prefix}-{self.next_room_id}" in self.rooms:
+                self.next_room_id += 1
+            name = f"{self.room_prefix}-{self.next_room_id}"
+        room = GameServer(self.timers, name, self.room_size, public, self.overflow_policy, self.tick_rate)
+        self.rooms[name] = room
+        print(f"[RoomManager] Room {name} has been created")
+        return room
+
+    def remove_room(self, room):
+        if len(room.connected_players) == 0 and self.rooms.get(room.name) is room:
+            self.rooms.pop(room.name)
+            room.stop_timer()
+            print(f"[RoomManager] Room {room.name} has been closed")
+
+    def find_room(self, name):
+        # Fill the fullest public room first so that games start as early as possible
+        best = None
+        for room in self.rooms.values():
+            if not room.public or room.is_full() or room.has_player(name):
+                continue
+            if best is None or len(room.connected_players) > len(best.connected_players):
+                best = room
+        return best
+
+    def matchmaking_status(self):
+        room = self.find_room(None)
+        return len(room.connected_players) if room is not None else 0, len(self.player_rooms)
+
+    def player_join(self, conn, payload):
+        if conn.getpeername() in self.player_rooms:
+            return
+        name, _, payload = payload.partition(",")
+        version, _, room_name = payload.partition(",")
+        version = parse_number(version)
+        version = min(version, protocol.PROTOCOL_VERSION) if version is not None else protocol.TEXT_VERSION
+        if not re.fullmatch(NAME_REGEX, name) or room_name and not re.fullmatch(NAME_REGEX, room_name):
+            send_packet(conn, "N", "BADNAME")
+            return
+
+        if room_name:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.create_room(room_name, public=False)
+            elif room.is_full():
+                send_packet(conn, "N", "ROOMFULL")
+                return
+            self.enter_room(room, conn, name, version)
+        else:
+            self.matchmaking.append((conn, name, version))
+            self.match()
+
+    def match(self):
+        while self.matchmaking:
+            conn, name, version = self.matchmaking.popleft()
+            if conn.fileno() == -1: continue
+            room = self.find_room(name)
+            if room is None:
+                room = self.create_room()
+            self.enter_room(room, conn, name, version)
+
+    def enter_room(self, room, conn, name, version):
+        if room.player_join(conn, name, version):
+            self.player_rooms[conn.getpeername()] = room
+            player = room.connected_players[conn.getpeername()]
+            self.watch_idle(player)
+            self.start_session(player)
+        else:
+            self.remove_room(room)
+        if self.on_change is not None:
+            self.on_change()
+
+    def start_session(self, player):
+        if self.resume_grace <= 0:
+            return
+        token = secrets.token_hex(16)
+        # Sharded workers prefix their tokens, so the acceptor hands a resume back to the same worker
+        player.token = token if self.shard is None else f"{self.shard}-{token}"
+        self.sessions[player.token] = player
+        player.send_game_message("SESSION", player.token)
+
+    def player_resume(self, conn, payload):
+        if conn.getpeername() in self.player_rooms:
+            return
+        token, version, resets, step = (payload.split(",") + [""] * 4)[:4]
+        version, resets, step = parse_number(version), parse_number(resets), parse_number(step)
+        if version is None or resets is None or step is None:
+            # Nothing to resume from a packet that does not parse
+            token = None
+        else:
+            version = min(version, protocol.PROTOCOL_VERSION)
+        player = self.sessions.get(token)
+        if player is None:
+            send_packet(conn, "N", "EXPIRED")
+            return
+        if player.resume_timer is not None:
+            player.resume_timer.cancel()
+            player.resume_timer = None
+        else:
+            # The old connection has not noticed it is gone yet, the new one takes over
+            if player.idle_timer is not None:
+                player.idle_timer.cancel()
+            player.conn.abort()
+        room = self.player_rooms.pop(player.addr)
+        room.player_resume(player, conn, version, resets, step)
+        self.player_rooms[player.addr] = room
+        self.watch_idle(player)
+
+    def player_disconnect(self, addr):
+        if addr in self.player_rooms:
+            player = self.player_rooms[addr].connected_players[addr]
+            if player.idle_timer is not None:
+                player.idle_timer.cancel()
+                player.idle_timer = None
+            if player.token is not None:
+                # Keep the seat, score and turn for a while in case the player comes back
+                print(f"[RoomManager] {player.name} ({addr}) lost connection, holding the seat for "
+                      f"{self.resume_grace} seconds")
+                player.resume_timer = self.timers.call_later(self.resume_grace, self.remove_player, player)
+                return
+            self.remove_player(player)
+
+    def remove_player(self, player):
+        self.sessions.pop(player.token, None)
+        player.resume_timer = None
+        room = self.player_rooms.pop(player.addr)
+        room.player_disconnect(player.addr)
+        self.remove_room(room)
+        if self.on_change is not None:
+            self.on_change()
+
+    def watch_idle(self, player):
+        if self.idle_timeout <= 0:
+            return
+        player.last_active = self.timers.clock()
+        player.idle_timer = self.timers.call_later(self.idle_timeout, self.check_idle, player)
+
+    def check_idle(self, player):
+        # Activity only stamps last_active, the timer is pushed back when it comes due
+        idle = self.timers.clock() - player.last_active
+        if idle < self.idle_timeout:
+            player.idle_timer = self.timers.call_later(self.idle_timeout - idle, self.check_idle, player)
+            return
+        player.idle_timer = None
+        print(f"[RoomManager] Disconnecting {player.name} ({player.addr}), idle for {int(idle)} seconds")
+        # An idle player is gone for good, there is no session to resume
+        self.sessions.pop(player.token, None)
+        player.token = None
+        player.conn.abort()
+
+    def report_stats(self):
+        now = self.timers.clock()
+        elapsed = max(now - self.stats_since, 1e-9)
+        ops, frames, sends = metrics["draw_ops"], metrics["paint_frames"], metrics["sends"]
+        mode = f"{self.tick_rate:g} Hz ticks" if self.tick_rate > 0 else "no ticks"
+        print(f"[RoomManager] Stats ({mode}): {ops / elapsed:.1f} draw ops/s to {len(self.player_rooms)} players "
+              f"in {frames / elapsed:.1f} paint frames/s ({ops / max(frames, 1):.1f} ops per frame), "
+              f"{sends / elapsed:.1f} socket sends/s")
+        metrics.update(draw_ops=0, paint_frames=0, sends=0)
+        self.stats_since = now
+        self.timers.call_later(self.stats_interval, self.report_stats)
+
+    def decode_packet(self, sender_conn, channel, pkt_type, payload):
+        if channel == "G" and pkt_type == "JOIN":
+            self.player_join(sender_conn, payload)
+            return
+        if channel == "G" and pkt_type == "RESUME":
+            self.player_resume(sender_conn, payload)
+            return
+        room = self.player_rooms.get(sender_conn.getpeername())
+        if room is not None:
+            room.connected_players[sender_conn.getpeername()].last_active = self.timers.clock()
+            room.decode_packet(sender_conn, channel, pkt_type, payload)
+
+
+class Connection:
+    def __init__(self, sock, addr, send_limit=SEND_BUFFER_LIMIT):
+        self.sock = sock
+        self.addr = addr
+        self.binary = False
+        self.indexed = False
+        self.packet_reader = protocol.PacketReader()
+        self.send_limit = send_limit
+        self.outbound = deque()
+        self.sending = b""
+        self.pending = 0
+        self.writing = False
+        self.overflowing = False
+        self.aborted = False
+        self.on_overflow = None
+
+    def set_version(self, version):
+        self.binary = version >= protocol.BINARY_VERSION
+        self.indexed = version >= protocol.INDEXED_VERSION
+        self.packet_reader.binary = self.binary
+
+    def getpeername(self):
+        return self.addr
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer):
+        return self.sock.recv_into(buffer)
+
+    def send(self, data, paint=False):
+        if self.aborted or self.fileno() == -1:
+            return
+        self.outbound.append((data, paint))
+        self.pending += len(data)
+        # While waiting for the selector to report the socket writable, only queue the data
+        if not self.writing:
+            self.flush()
+        if self.backlog() > self.send_limit and self.on_overflow is not None and not self.overflowing:
+            self.overflowing = True
+            self.on_overflow()
+            self.overflowing = False
+
+    def backlog(self):
+        return self.pending
+
+    def drop_paint_backlog(self):
+        self.outbound = deque(frame for frame in self.outbound if not frame[1])
+        self.pending = len(self.sending) + sum(len(data) for data, _ in self.outbound)
+
+    def flush(self):
+        try:
+            while self.sending or self.outbound:
+                if not self.sending:
+                    self.sending = memoryview(b"".join(data for data, _ in self.outbound))
+                    self.outbound.clear()
+                metrics["sends"] += 1
+                sent = self.sock.send(self.sending)
+                self.sending = self.sending[sent:]
+                self.pending -= sent
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f"[Server] Failed to send to {self.addr}: {e}")
+            self.sending = b""
+            self.outbound.clear()
+            self.pending = 0
+            self.abort()
+            return
+        self.set_writing(len(self.sending) > 0 or len(self.outbound) > 0)
+
+    def set_writing(self, writing):
+        if writing == self.writing or self.fileno() == -1:
+            return
+        self.writing = writing
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+        selector.modify(self, events, selector.get_key(self).data)
+
+    def abort(self):
+        # Closing is left to the read side, which sees the shutdown as EOF and cleans up the player
+        self.aborted = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
-        if self.task == "turn":
-            self.counter = 60
-        elif self.task == "break":
-            self.counter = 5
-        self.lock.release()
 
-    def stop(self):
-        self.stop = True
+    def close(self):
+        self.sock.close()
+
+
+class AsyncConnection(Connection):
+    def __init__(self, reader, writer, send_limit=SEND_BUFFER_LIMIT):
+        super().__init__(writer.get_extra_info("socket"), writer.get_extra_info("peername"), send_limit)
+        self.reader = reader
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.writer_task = asyncio.get_running_loop().create_task(self.run_writer())
 
+    def fileno(self):
+        return -1 if self.writer.is_closing() else self.sock.fileno()
 
-def send_packet(conn, channel, msg):
-    conn.sendall(f"{channel},{msg}@".encode())
+    def backlog(self):
+        return self.pending + self.writer.transport.get_write_buffer_size()
 
+    def flush(self):
+        metrics["sends"] += 1
+        self.writer.write(b"".join(data for data, _ in self.outbound))
+        self.outbound.clear()
+        self.pending = 0
+        if self.writer.transport.get_write_buffer_size() > 0:
+            # Frames queued while draining stay in outbound, where the overflow policy can coalesce them
+            self.writing = True
+            self.ready.set()
+
+    async def run_writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                await self.writer.drain()
+                self.writing = False
+                if self.outbound:
+                    self.flush()
+        except ConnectionError as e:
+            print(f"[Server] Failed to send to {self.addr}: {e}")
+            self.abort()
+
+    def abort(self):
+        self.aborted = True
+        self.writer.transport.abort()
+
+    def close(self):
+        self.writer_task.cancel()
+        self.writer.close()
+
+
+async def run_timers(timers):
+    wakeup = asyncio.Event()
+    # A timer scheduled while sleeping may be due before the current timeout
+    timers.on_schedule = wakeup.set
+    while True:
+        try:
+            await asyncio.wait_for(wakeup.wait(), timers.next_timeout())
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        timers.advance()
 
-def read_data_from_client(conn, addr, game_server):
+
+def parse_number(text):
+    # Packet fields are untrusted: str.isdigit also takes digits like "²" that int() rejects
+    return int(text) if text.isascii() and text.isdigit() and len(text) <= 9 else None
+
+
+def send_packet(conn, channel, pkt_type, payload=""):
+    send_frame(conn, {}, channel, pkt_type, payload)
+
+
+def send_frame(conn, frames, channel, pkt_type, payload=""):
+    if pkt_type in PAINT_FRAMES:
+        metrics["paint_frames"] += 1
+    conn.send(encode_frame(conn, frames, channel, pkt_type, payload), pkt_type in COALESCED_FRAMES)
+
+
+def encode_frame(conn, frames, channel, pkt_type, payload=""):
+    # frames caches the encoded packet per protocol mode, so a broadcast encodes it at most twice
+    data = frames.get(conn.binary)
+    if data is None:
+        data = frames[conn.binary] = protocol.encode_packet(channel, pkt_type, payload, conn.binary)
+    return data
+
+
+def handle_message(conn, addr, data, room_manager):
+    conn.packet_reader.feed(data)
+    handle_packets(conn, addr, data, room_manager)
+
+
+def handle_packets(conn, addr, data, room_manager):
+    if log_packets:
+        print(f"[From client {addr}]: {bytes(data)}")
+    if conn.aborted:
+        # Reads that arrive before the shutdown shows up as EOF are not trusted either
+        return
     try:
-        msg = str(conn.recv(4096), encoding='utf-8')
-        if msg:
-            print(f"[From client {addr}]: {msg}")
-            packets = msg.split("@")
-            for packet in packets:
-                if len(packet) == 0: continue
-                channel, channel_pkt = packet.split(",", 1)
-                if channel == "G" or channel == "N":
-                    pkt_type, payload = channel_pkt.split(",", 1)
-                    game_server.decode_packet(conn, channel, pkt_type, payload)
-                else:
-                    game_server.decode_packet(conn, channel, None, channel_pkt)
+        for channel, pkt_type, payload in conn.packet_reader.packets():
+            room_manager.decode_packet(conn, channel, pkt_type, payload)
+    except protocol.ProtocolError as e:
+        print(f"[Server] Disconnecting {addr}: {e}")
+        conn.abort()
+    except Exception as e:
+        # Whatever a packet broke, only its sender is dropped, the other rooms keep running
+        print(f"[Server] Disconnecting {addr}, failed to handle its packet: {e!r}")
+        conn.abort()
+
+
+def read_data_from_client(conn, addr, room_manager):
+    try:
+        # Receive straight into the connection's packet buffer, a partial frame stays there for the next read
+        size = conn.recv_into(conn.packet_reader.writable())
+        if size:
+            handle_packets(conn, addr, conn.packet_reader.commit(size), room_manager)
         else:
-            game_server.player_disconnect(addr)
-            selector.unregister(conn)
-            conn.close()
+            close_connection(conn, addr, room_manager)
     except ConnectionError:
         print(f"[Server] Lost connection to {addr}")
-        pass
+        close_connection(conn, addr, room_manager)
 
 
-def accept(server, game_server):
-    conn, addr = server.accept()
-    conn.setblocking(False)
+def close_connection(conn, addr, room_manager):
+    selector.unregister(conn)
+    conn.close()
+    room_manager.player_disconnect(addr)
+
+
+def accept(server, room_manager):
+    sock, addr = server.accept()
+    sock.setblocking(False)
 
     print(f"[Server] Server is connected to {addr}")
 
+    selector.register(Connection(sock, addr, room_manager.send_limit), selectors.EVENT_READ,
+                      (read_data_from_client, addr))
+
+
+def receive_connection(control, room_manager):
+    global running
+    data, fds, _, _ = socket.recv_fds(control, HANDOFF_SIZE, 1)
+    if not data:
+        # The acceptor is gone, so no more players can reach this worker
+        running = False
+        return
+    if len(fds) == 0:
+        return
+    sock = socket.socket(fileno=fds[0])
+    sock.setblocking(False)
+    addr = sock.getpeername()
+    conn = Connection(sock, addr, room_manager.send_limit)
+
+    print(f"[Server] Received connection {addr} from the acceptor")
+
     selector.register(conn, selectors.EVENT_READ, (read_data_from_client, addr))
+    handle_message(conn, addr, data, room_manager)
+
+
+async def serve_client(reader, writer, room_manager, data=b""):
+    conn = AsyncConnection(reader, writer, room_manager.send_limit)
+    addr = conn.addr
+
+    print(f"[Server] Server is connected to {addr}")
+
+    try:
+        if data:
+            handle_message(conn, addr, data, room_manager)
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            handle_message(conn, addr, data, room_manager)
+    except ConnectionError:
+        print(f"[Server] Lost connection to {addr}")
+    finally:
+        room_manager.player_disconnect(addr)
+        conn.close()
+
+
+async def async_main(host, port, room_size=ROOM_SIZE, overflow_policy="snapshot", send_limit=SEND_BUFFER_LIMIT,
+                     idle_timeout=IDLE_TIMEOUT, resume_grace=RESUME_GRACE, tick_rate=TICK_RATE, stats_interval=0):
+    room_manager = RoomManager(room_size, overflow_policy, send_limit, idle_timeout=idle_timeout,
+                               resume_grace=resume_grace, tick_rate=tick_rate, stats_interval=stats_interval)
+    asyncio.get_running_loop().create_task(run_timers(room_manager.timers))
+    server = await asyncio.start_server(lambda reader, writer: serve_client(reader, writer, room_manager),
+                                        host, port, reuse_address=True)
+
+    print(f"[Server] Server is listening on {(host, port)} (asyncio)")
+
+    async with server:
+        await server.serve_forever()
+
+
+async def async_worker_main(control, room_manager):
+    loop = asyncio.get_running_loop()
+    timers = loop.create_task(run_timers(room_manager.timers))
 
+    async def serve_handoff(sock, data):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await serve_client(reader, writer, room_manager, data)
 
-def main():
+    def on_control():
+        data, fds, _, _ = socket.recv_fds(control, HANDOFF_SIZE, 1)
+        if not data:
+            loop.remove_reader(control.fileno())
+            acceptor_closed.set_result(None)
+        elif len(fds) > 0:
+            loop.create_task(serve_handoff(socket.socket(fileno=fds[0]), data))
+
+    acceptor_closed = loop.create_future()
+    control.setblocking(False)
+    loop.add_reader(control.fileno(), on_control)
+    await acceptor_closed
+    timers.cancel()
+
+
+def report_status(control, room_manager):
+    fill, players = room_manager.matchmaking_status()
+    try:
+        control.send(f"{fill},{players}".encode())
+    except OSError:
+        pass
+
+
+def worker_main(index, control, use_asyncio, room_size, overflow_policy, send_limit, idle_timeout, resume_grace,
+                tick_rate, stats_interval, log_reads):
+    global log_packets
+    # Spawned workers import this module afresh, so the flag has to be handed over
+    log_packets = log_reads
+    print(f"[Worker {index}] Worker is running")
+    room_manager = RoomManager(room_size, overflow_policy, send_limit, f"room-{index}", idle_timeout, resume_grace,
+                               index, tick_rate, stats_interval)
+    room_manager.on_change = lambda: report_status(control, room_manager)
+    if use_asyncio:
+        asyncio.run(async_worker_main(control, room_manager))
+        return
+
+    control.setblocking(False)
+    selector.register(control, selectors.EVENT_READ, (receive_connection,))
+    serve_forever(room_manager)
+
+
+class ShardSupervisor:
+    def __init__(self, workers, use_asyncio, room_size, overflow_policy, send_limit, idle_timeout, resume_grace,
+                 tick_rate, stats_interval):
+        # Spawned workers start clean instead of inheriting the acceptor's sockets and selector
+        self.context = multiprocessing.get_context("spawn")
+        self.worker_args = (use_asyncio, room_size, overflow_policy, send_limit, idle_timeout, resume_grace,
+                            tick_rate, stats_interval, log_packets)
+        self.room_size = room_size
+        self.workers = [None] * workers
+        # Per worker: players in its fullest open public room, and players in total
+        self.status = [(0, 0)] * workers
+        for index in range(workers):
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = self.context.Process(target=worker_main, args=(index, worker_control, *self.worker_args),
+                                       daemon=True)
+        process.start()
+        worker_control.close()
+        control.setblocking(False)
+        self.workers[index] = (process, control)
+        self.status[index] = (0, 0)
+        selector.register(control, selectors.EVENT_READ, (read_worker_status, index))
+        print(f"[Supervisor] Worker {index} has started (pid {process.pid})")
+
+    def check_workers(self):
+        for index, (process, control) in enumerate(self.workers):
+            if not process.is_alive():
+                print(f"[Supervisor] Worker {index} (pid {process.pid}) exited with {process.exitcode}, restarting")
+                if control in selector.get_map():
+                    selector.unregister(control)
+                control.close()
+                self.start_worker(index)
+
+    def pick_worker(self, pkt_type, payload):
+        if pkt_type == "RESUME":
+            # The session lives in the worker that issued the token
+            shard = parse_number(payload.partition("-")[0])
+            return shard % len(self.workers) if shard is not None else 0
+        name, _, payload = payload.partition(",")
+        version, _, room_name = payload.partition(",")
+        if room_name:
+            return zlib.crc32(room_name.encode()) % len(self.workers)
+        # Like RoomManager.find_room: prefer the fullest open room, otherwise the least loaded worker
+        index = max(range(len(self.workers)), key=lambda i: (self.status[i][0], -self.status[i][1]))
+        fill, players = self.status[index]
+        # Count the player right away, the worker's own report follows once it has joined
+        self.status[index] = ((fill + 1) % self.room_size, players + 1)
+        return index
+
+    def hand_off(self, sock, addr, data):
+        # Only split the first packet, a full decode would choke on whatever a stranger sends instead of a JOIN
+        end = data.find(b"@")
+        channel, _, rest = str(data[:end], encoding='utf-8', errors='replace').partition(",")
+        pkt_type, _, payload = rest.partition(",")
+        if channel != "G" or pkt_type not in ("JOIN", "RESUME"):
+            print(f"[Supervisor] Closing {addr}, its first packet is not a JOIN or RESUME")
+            return
+        index = self.pick_worker(pkt_type, payload)
+        process, control = self.workers[index]
+        try:
+            socket.send_fds(control, [bytes(data)], [sock.fileno()])
+            print(f"[Supervisor] Handed {addr} to worker {index}")
+        except OSError as e:
+            print(f"[Supervisor] Failed to hand {addr} to worker {index}: {e}")
+
+    def stop(self):
+        for process, control in self.workers:
+            process.terminate()
+            control.close()
+
+
+def read_worker_status(control, index, supervisor):
+    try:
+        status = control.recv(64)
+    except OSError:
+        status = b""
+    if not status:
+        # The worker has exited, check_workers will restart it
+        selector.unregister(control)
+        return
+    fill, players = status.split(b",")
+    supervisor.status[index] = (int(fill), int(players))
+
+
+def read_join_request(sock, addr, buffer, supervisor):
+    try:
+        data = sock.recv(HANDOFF_SIZE - len(buffer))
+    except OSError:
+        data = b""
+    buffer += data
+    # Wait for the first packet, the JOIN request decides which worker owns the connection
+    if data and buffer.find(b"@") == -1 and len(buffer) < HANDOFF_SIZE:
+        return
+    selector.unregister(sock)
+    if data and buffer.find(b"@") != -1:
+        try:
+            supervisor.hand_off(sock, addr, buffer)
+        except Exception as e:
+            # Whatever the packet was, only this connection pays for it, the acceptor serves every shard
+            print(f"[Supervisor] Failed to hand {addr} to a worker: {e}")
+    sock.close()
+
+
+def accept_for_worker(server, supervisor):
+    sock, addr = server.accept()
+    sock.setblocking(False)
+    selector.register(sock, selectors.EVENT_READ, (read_join_request, addr, bytearray()))
+
+
+def open_server(host, port):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.setblocking(False)
-    server.bind((HOST, PORT))
+    server.bind((host, port))
     server.listen(10)
+    return server
 
-    print(f"[Server] Server is listening on {(HOST, PORT)}")
-
-    game_server = GameServer()
-
-    selector.register(server, selectors.EVENT_READ, (accept,))
 
+def serve_forever(room_manager):
+    timers = room_manager.timers
     while running:
-        for key, mask in selector.select():
+        for key, mask in selector.select(timeout=timers.next_timeout()):
             data = key.data
             callback = data[0]
             client_socket = key.fileobj
+            if mask & selectors.EVENT_WRITE:
+                client_socket.flush()
+            if not mask & selectors.EVENT_READ:
+                continue
             if len(data) > 1:
-                callback(client_socket, data[1], game_server)
+                callback(client_socket, data[1], room_manager)
             else:
-                callback(client_socket, game_server)
+                callback(client_socket, room_manager)
+        timers.advance()
+
+
+def shard_main(host=HOST, port=PORT, workers=2, use_asyncio=False, room_size=ROOM_SIZE,
+               overflow_policy="snapshot", send_limit=SEND_BUFFER_LIMIT, idle_timeout=IDLE_TIMEOUT,
+               resume_grace=RESUME_GRACE, tick_rate=TICK_RATE, stats_interval=0):
+    supervisor = ShardSupervisor(workers, use_asyncio, room_size, overflow_policy, send_limit, idle_timeout,
+                                 resume_grace, tick_rate, stats_interval)
+    server = open_server(host, port)
+
+    print(f"[Server] Server is listening on {(host, port)} with {workers} workers")
+
+    selector.register(server, selectors.EVENT_READ, (accept_for_worker,))
+
+    while running:
+        for key, mask in selector.select(timeout=1):
+            data = key.data
+            data[0](key.fileobj, *data[1:], supervisor)
+        supervisor.check_workers()
 
     print(f"[Server] Server is shutting down...")
 
-    if len(game_server.connected_players) > 0:
+    supervisor.stop()
+    server.close()
+    selector.close()
+
+
+def main(host=HOST, port=PORT, room_size=ROOM_SIZE, overflow_policy="snapshot", send_limit=SEND_BUFFER_LIMIT,
+         idle_timeout=IDLE_TIMEOUT, resume_grace=RESUME_GRACE, tick_rate=TICK_RATE, stats_interval=0):
+    server = open_server(host, port)
+
+    print(f"[Server] Server is listening on {(host, port)}")
+
+    room_manager = RoomManager(room_size, overflow_policy, send_limit, idle_timeout=idle_timeout,
+                               resume_grace=resume_grace, tick_rate=tick_rate, stats_interval=stats_interval)
+
+    selector.register(server, selectors.EVENT_READ, (accept,))
+
+    serve_forever(room_manager)
+
+    print(f"[Server] Server is shutting down...")
+
+    if len(room_manager.player_rooms) > 0:
         server.shutdown(socket.SHUT_RD)
     server.close()
     selector.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="SoulPainter game server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--asyncio", action="store_true", help="run the asyncio server core")
+    parser.add_argument("--room-size", type=int, default=ROOM_SIZE, help="players per room")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run rooms in this many worker processes behind one acceptor (Unix only)")
+    parser.add_argument("--send-buffer", type=int, default=SEND_BUFFER_LIMIT,
+                        help="bytes that may be queued for a client before the overflow policy applies")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default="snapshot",
+                        help="coalesce a slow client's paint backlog into a snapshot, or disconnect it")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds without any packet before a player is disconnected, 0 disables it")
+    parser.add_argument("--resume-grace", type=float, default=RESUME_GRACE,
+                        help="seconds a dropped player can reconnect and resume their session, 0 disables it")
+    parser.add_argument("--tick-rate", type=float, default=TICK_RATE,
+                        help="send each player the draw ops of a room batched this many times a second, "
+                             "0 sends every op as it arrives")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="print draw op, paint frame and socket send rates every this many seconds, 0 disables it")
+    parser.add_argument("--log-packets", action="store_true", help="print every read from a client")
+    args = parser.parse_args()
+    log_packets = args.log_packets
+
+    if args.workers > 0:
+        try:
+            shard_main(args.host, args.port, args.workers, args.asyncio, args.room_size, args.overflow_policy,
+                       args.send_buffer, args.idle_timeout, args.resume_grace, args.tick_rate, args.stats_interval)
+        except KeyboardInterrupt:
+            print(f"[Server] Server is shutting down...")
+    elif args.asyncio:
+        try:
+            asyncio.run(async_main(args.host, args.port, args.room_size, args.overflow_policy, args.send_buffer,
+                                   args.idle_timeout, args.resume_grace, args.tick_rate, args.stats_interval))
+        except KeyboardInterrupt:
+            print(f"[Server] Server is shutting down...")
+    else:
+        main(args.host, args.port, args.room_size, args.overflow_policy, args.send_buffer, args.idle_timeout,
+             args.resume_grace, args.tick_rate, args.stats_interval)